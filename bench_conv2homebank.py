@@ -0,0 +1,607 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Pierre
+# Purpose: measure the speed of conv2homebank on synthetic data
+###############################################################################
+#
+#
+###############################################################################
+"""@package docstring
+
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import random
+import platform
+import shutil
+import timeit
+import filecmp
+import tempfile
+import argparse
+import tracemalloc
+import multiprocessing
+
+import conv2homebank as c2h
+
+logger = logging.getLogger(__name__)
+
+# Descriptions found in Boursorama exports
+BOURSORAMA_DESCR = ['PAIEMENT CARTE {date} 75{shop}',
+                    'RETRAIT DAB {date} 75PARIS {num}',
+                    'VIR SEPA {name}',
+                    'PRLV SEPA {shop}',
+                    'CHQ. N.{num}',
+                    'VIR INTERNE {num}',
+                    'PRLV {shop}',
+                    'Relev\xe9 diff\xe9r\xe9 Carte 4978XXXX{num}',
+                    ]
+SHOPS = ['CARREFOUR', 'MONOPRIX', 'SNCF', 'EDF', 'FREE MOBILE', 'FNAC',
+         'AMAZON EU', 'PHARMACIE DU CENTRE', 'BOULANGERIE', 'TOTAL']
+NAMES = ['M DUPONT JEAN', 'MME MARTIN', 'EMPLOYEUR SA', 'CAF PARIS']
+# Buchungstext of ING operations
+ING_TYPES = ['Lastschrifteinzug', 'Uberweisung', 'Gutschrift',
+             'Dauerauftrag/Terminueberweisung', 'Entgelt']
+
+
+# phases shorter than this (s) are not compared to the baseline: their time
+# is in the noise of the machine
+MIN_COMPARED_TIME = 0.05
+
+# the outputs of the check benchmark are compared to the files of this
+# directory (written with --update)
+EXPECTED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'bench_expected')
+CHECK_RECORDS = 40
+# category rules of the check benchmark, matching generated operations
+CHECK_CATEGORIES = [
+    {'type': 'exact', 'pattern': 'EDF', 'category': 'Logement:Energie'},
+    {'type': 'prefix', 'pattern': 'CARREFOUR', 'category': 'Alimentation',
+     'tags': 'courses'},
+    {'type': 'regex', 'pattern': '^PRLV', 'field': 'memo',
+     'category': 'Factures'},
+    ]
+# export of another German bank, whose header looks like the ING one
+SPARKASSE_CSV = ('"Auftragskonto";"Buchungstag";"Valutadatum";'
+                 '"Buchungstext";"Verwendungszweck";"Betrag"\n'
+                 '"1234567890";"01.12.14";"01.12.14";"LASTSCHRIFT";'
+                 '"EDF";"-12,34"\n')
+
+
+def gen_boursorama_descr(n, seed=0):
+    ''' n descriptions of Boursorama operations, always the same for a seed '''
+    rnd = random.Random(seed)
+    descr_l = []
+    for _ in range(n):
+        descr_l.append(rnd.choice(BOURSORAMA_DESCR).format(
+            date='{:02d}{:02d}14'.format(rnd.randint(1, 28),
+                                         rnd.randint(1, 12)),
+            shop=rnd.choice(SHOPS),
+            name=rnd.choice(NAMES),
+            num=rnd.randint(1000000, 9999999)))
+    return descr_l
+
+
+def gen_boursorama_qif(out_file, n, seed=0):
+    ''' Boursorama QIF export of n operations '''
+    rnd = random.Random(seed)
+    with open(out_file, 'w', encoding='cp1252', newline='') as fid:
+        fid.write('!Type:Ccard\n')
+        for descr in gen_boursorama_descr(n, seed):
+            amount = rnd.randint(-300000, 100000)
+            fid.write("D{:02d}/{:02d}'14\n".format(rnd.randint(1, 12),
+                                                  rnd.randint(1, 28)))
+            fid.write('T{:,.2f}\n'.format(amount / 100.))
+            fid.write('P{}\n'.format(descr))
+            fid.write('^\n')
+
+
+def format_de(cents):
+    ''' German representation of an amount (-1.234,56) '''
+    return '{:,.2f}'.format(cents / 100.).replace(',', ' ')\
+                                         .replace('.', ',').replace(' ', '.')
+
+
+def gen_ing_csv(out_file, n, seed=0):
+    ''' ING DiBa export of n operations (newest first, with its preamble) '''
+    rnd = random.Random(seed)
+    saldo = 1000000
+    with open(out_file, 'w', encoding='cp1252', newline='') as fid:
+        fid.write('Umsatzanzeige;Datei erstellt am: 31.12.2014 12:00\n\n'
+                  'IBAN;DE12 3456 7890 1234 5678 90\n'
+                  'Kontoname;Girokonto\nBank;ING-DiBa\nKunde;Max M\xfcller\n'
+                  'Zeitraum;01.01.2014 - 31.12.2014\n'
+                  'Saldo;{};EUR\n\nSortierung;Datum absteigend\n\n'
+                  .format(format_de(saldo)))
+        fid.write('Buchung;Valuta;Auftraggeber/Empf\xe4nger;Buchungstext;'
+                  'Verwendungszweck;Saldo;W\xe4hrung;Betrag;W\xe4hrung\n')
+        for idx in range(n):
+            day = '{:02d}.{:02d}.2014'.format(rnd.randint(1, 28),
+                                              rnd.randint(1, 12))
+            amount = rnd.randint(-300000, 100000)
+            fid.write('{0};{0};{1};{2};{3} {4};{5};EUR;{6};EUR\n'.format(
+                day, rnd.choice(SHOPS + NAMES), rnd.choice(ING_TYPES),
+                'Einkauf M\xfcnchen', idx, format_de(saldo),
+                format_de(amount)))
+            saldo -= amount
+
+
+def gen_linxo_csv(out_file, n, seed=0):
+    ''' Linxo export of n operations (UTF-16, tab separated) '''
+    rnd = random.Random(seed)
+    with open(out_file, 'w', encoding='utf-16', newline='') as fid:
+        fid.write('Date\tLibell\xe9\tCat\xe9gorie\tMontant\tNotes\t'
+                  'N\xb0 de ch\xe8que\tLabels\n')
+        for idx in range(n):
+            fid.write('{:02d}/{:02d}/2014\t{}\t{}\t{}\t\t{}\t\n'.format(
+                rnd.randint(1, 28), rnd.randint(1, 12),
+                rnd.choice(SHOPS + NAMES),
+                rnd.choice(['Alimentation', 'Transports', 'Logement']),
+                format_de(rnd.randint(-300000, 100000)),
+                rnd.choice(['', rnd.randint(1000000, 9999999)])))
+
+
+# generator and file name of each supported format
+generators = {'Boursorama_qif': (gen_boursorama_qif,
+                                 '00000000000_Q20141231.qif'),
+              'INGDiba_csv': (gen_ing_csv,
+                              'Umsatzanzeige_1234567890_20141231.csv'),
+              'Linxo_csv': (gen_linxo_csv, 'op\xe9rations.csv'),
+              }
+
+
+class legacy_ING_DiBa_csv_file(c2h.ING_DiBa_csv_file):
+    ''' ING parser reading the file through a temporary file and looking up
+    the header for each field, as done before (reference for the
+    benchmarks) '''
+    encoding = 'utf-8'
+
+    def open_csv(self):
+        with open(self.in_file, encoding="cp1252") as fid:
+            fbuff = fid.read()
+        fbuff = fbuff[fbuff.find("Buchung"):]
+        fid = tempfile.NamedTemporaryFile(delete=False)
+        fid.write(fbuff.encode('utf8'))
+        fid.close()
+        with open(fid.name, 'rb') as csvfile:
+            lines = (line.decode('utf-8') for line in csvfile)
+            for row in csv.reader(lines, delimiter=';', quotechar='"'):
+                if self.headerline is None:
+                    self.headerline = [item.rstrip('"') for item in row]
+                else:
+                    sub_d = self.read_op_l(row)
+                    self.op_d.add(sub_d["Buchung"], sub_d)
+        os.unlink(fid.name)
+
+    def read_op_l(self, op_l):
+        sub_d = {}
+        for item in self.headerline:
+            if item in ["Buchung", "Valuta"]:
+                sub_d[item] = c2h.day_ordinal(
+                    op_l[self.headerline.index(item)].replace('"', '')
+                    .rstrip(' '), '%d.%m.%Y')
+            elif item in ["Betrag", "Saldo"]:
+                sub_d[item] = int(round(100 * float(
+                    op_l[self.headerline.index(item)]
+                    .replace('"', '').rstrip(' ')
+                    .replace('.', '').replace(',', '.'))))
+            else:
+                sub_d[item] = op_l[self.headerline.index(item)].rstrip(' ')
+        return sub_d
+
+
+class legacy_HomeBankDataWriter(c2h.HomeBankDataWriter):
+    ''' Writer issuing one write per field and logging each CSV row, with a
+    loop per format, as done before (reference for the benchmarks) '''
+    def export_qif(self, out_file):
+        with open(out_file, 'wb') as fid:
+            fid.write((self.headerline or '!Type:Bank\n').encode('utf8'))
+            for rec in self.op_d:
+                fid.write('D{}\n'.format(rec.date).encode('utf8'))
+                fid.write('T{}\n'.format(rec.amount).encode('utf8'))
+                fid.write('P{}\n'.format(rec.payee).encode('utf8'))
+                fid.write('M{}\n'.format(rec.memo).encode('utf8'))
+                fid.write(b'^\n')
+
+    def export_csv(self, out_file):
+        with open(out_file, 'wb') as fid:
+            fid.write(';'.join(c2h.CSV_HEAD).encode('utf8'))
+            fid.write(b'\n')
+            for rec in self.op_d:
+                l = []
+                for item in ['date', 'paymode', 'info', 'payee', 'memo',
+                             'amount', 'category', 'tags']:
+                    t = getattr(rec, item)
+                    if t == None:
+                        l.append('')
+                    elif (isinstance(t, int) or isinstance(t, float)):
+                        l.append(str(t))
+                    elif isinstance(t, str):
+                        l.append(t)
+                    elif isinstance(t, bytes):
+                        l.append(t.decode('utf-8'))
+                    else:
+                        l.append(t)
+                c2h.logger.info(l)
+                fid.write(';'.join(l).encode('utf8'))
+                fid.write(b'\n')
+
+    def export(self, out_file_qif, out_file_csv):
+        self.export_qif(out_file_qif)
+        self.export_csv(out_file_csv)
+
+
+def gen_HB_store(n, seed=0):
+    ''' TransactionStore of n HomeBank records '''
+    rnd = random.Random(seed)
+    store = c2h.TransactionStore()
+    for descr in gen_boursorama_descr(n, seed):
+        rec = c2h.HBRecord(rnd.randint(735234, 735598),
+                           paymode=rnd.randint(0, 10),
+                           payee=store.intern(descr.split(' ')[-1]),
+                           memo=descr,
+                           cents=rnd.randint(-300000, 100000))
+        store.add(rec.day, rec)
+    return store
+
+
+def traced(func, *args):
+    ''' (func(*args), peak of the memory allocated by func in kB) '''
+    tracemalloc.start()
+    try:
+        out = func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return out, peak / 1024.
+
+
+def _measure(queue, func, args):
+    t0 = time.time()
+    func(*args)
+    seconds = time.time() - t0
+    queue.put((seconds, traced(func, *args)[1]))
+
+
+def measure(func, *args):
+    ''' (time in s, peak memory allocated in kB) of func(*args), run in a
+    separate process '''
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure, args=(queue, func, args))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def phase(res, name, repeat, func, *args):
+    ''' Run func(*args), recording in res[name] the peak of the memory it
+    allocates (kB) and its best time (s). The calls are timed by groups of
+    at least 0.2 s (timeit autorange), the best of repeat groups is kept,
+    so that fast phases are not in the noise of the clock. '''
+    out, peak_kb = traced(func, *args)
+    timer = timeit.Timer(lambda: func(*args))
+    number, seconds = timer.autorange()
+    seconds = min([seconds] + timer.repeat(repeat - 1, number))
+    res[name] = {'time': seconds / number, 'peak_kb': peak_kb}
+    return out
+
+
+def _run_phases(queue, typ, in_file, tmp_dir, repeat):
+    res = {}
+    try:
+        fmt = c2h.formats[typ]
+        data_d = phase(res, 'parse', repeat, fmt.get_parser(), in_file)
+        store = phase(res, 'dic2HBdic', repeat, data_d.dic2HBdic)
+        head = data_d.headerline if fmt.qif_head else None
+        phase(res, 'export', repeat,
+              c2h.HomeBankDataWriter(store, head).export,
+              os.path.join(tmp_dir, 'out.qif'),
+              os.path.join(tmp_dir, 'out.csv'))
+    except Exception as e:
+        res['error'] = '{}: {}'.format(type(e).__name__, e)
+    queue.put(res)
+
+
+def run_phases(typ, in_file, tmp_dir, repeat=3):
+    ''' Time and peak memory of the phases of the conversion of in_file,
+    in a separate process '''
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_phases,
+                                   args=(queue, typ, in_file, tmp_dir,
+                                         repeat))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def report(name, n, seconds, peak_kb):
+    print('{:<40} {:>10.0f} rows/s {:>8.1f} MB peak'.format(
+         name, n / seconds, peak_kb / 1024.))
+
+
+def per_record(func, n, repeat=5):
+    ''' Best time of func (processing n records) per record, in us '''
+    return min(timeit.repeat(func, number=1, repeat=repeat)) / n * 1e6
+
+
+def bench_rules(args, tmp_dir):
+    ''' Cost of the classification of a Boursorama description '''
+    n = args.n
+    descr_l = gen_boursorama_descr(n)
+    engine = c2h.boursorama_qif_file.rules
+    in_file = os.path.join(tmp_dir, '00000000000_Q20140101.qif')
+    gen_boursorama_qif(in_file, n)
+
+    def classify():
+        for descr in descr_l:
+            engine.classify(descr)
+
+    def parse():
+        for rec in c2h.boursorama_qif_file(in_file, stream=True).iter_HB():
+            pass
+
+    print('{:<40} {:>8.2f} us/record'.format('rules: RuleEngine.classify',
+                                              per_record(classify, n)))
+    print('{:<40} {:>8.2f} us/record'.format('rules: read and convert QIF',
+                                              per_record(parse, n)))
+
+
+def stream_ing(in_file):
+    for op_d in c2h.ING_DiBa_csv_file(in_file, stream=True).iter_op():
+        pass
+
+
+def bench_ing(args, tmp_dir):
+    ''' Reading of an ING export: temporary file and header lookups vs
+    streamed with a CsvRowDecoder '''
+    n = args.n
+    in_file = os.path.join(tmp_dir, 'Umsatzanzeige_1234567890_20141231.csv')
+    gen_ing_csv(in_file, n)
+    report('ing: temporary file (legacy)', n,
+           *measure(legacy_ING_DiBa_csv_file, in_file))
+    report('ing: streamed', n, *measure(c2h.ING_DiBa_csv_file, in_file))
+    report('ing: streamed, no store', n, *measure(stream_ing, in_file))
+
+
+def write_HB(writer_class, store, out_file_qif, out_file_csv):
+    writer_class(store, '!Type:Bank\n').export(out_file_qif, out_file_csv)
+
+
+def bench_writer(args, tmp_dir):
+    ''' Export of HomeBank records to QIF and CSV '''
+    n = args.n
+    store = gen_HB_store(n)
+    out_file_qif = os.path.join(tmp_dir, 'out.qif')
+    out_file_csv = os.path.join(tmp_dir, 'out.csv')
+    report('writer: one write per field (legacy)', n,
+           *measure(write_HB, legacy_HomeBankDataWriter, store,
+                    out_file_qif, out_file_csv))
+    report('writer: single pass, buffered', n,
+           *measure(write_HB, c2h.HomeBankDataWriter, store,
+                    out_file_qif, out_file_csv))
+
+
+def machine():
+    ''' Description of the machine, saved with the results of the suite '''
+    return {'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpus': multiprocessing.cpu_count()}
+
+
+def bench_suite(args, tmp_dir):
+    ''' Phases (parse, dic2HBdic, export) of each format at each size,
+    compared to the baseline if there is one '''
+    baseline = {}
+    if args.baseline is not None and os.path.isfile(args.baseline):
+        with open(args.baseline, encoding='utf8') as fid:
+            data = json.load(fid)
+        baseline = data['results']
+        # times only compare on the same machine
+        ref = data.get('machine', {})
+        print('=> Baseline {} (Python {}, {}, {} CPUs)'.format(
+            args.baseline, data.get('python'), ref.get('platform'),
+            ref.get('cpus')))
+
+    results = {}
+    regressions = 0
+    print('{:<30} {:<10} {:>10} {:>10} {:>10}'.format(
+         'suite: format/records', 'phase', 'us/record', 'MB peak', 'baseline'))
+    for n in args.sizes:
+        for typ in sorted(generators.keys()):
+            gen, name = generators[typ]
+            in_file = os.path.join(tmp_dir, name)
+            gen(in_file, n)
+            res = run_phases(typ, in_file, tmp_dir, args.repeat)
+            os.remove(in_file)
+            key = '{}/{}'.format(typ, n)
+            if 'error' in res:
+                print('{:<30} failed: {}'.format(key, res['error']))
+                continue
+            for name in ['parse', 'dic2HBdic', 'export']:
+                entry = {'us_per_record': res[name]['time'] / n * 1e6,
+                         'peak_mb': res[name]['peak_kb'] / 1024.}
+                results['{}/{}'.format(key, name)] = entry
+                ref = baseline.get('{}/{}'.format(key, name))
+                flag = ''
+                if ref is not None:
+                    ratio = entry['us_per_record'] / ref['us_per_record']
+                    flag = '{:+.0%}'.format(ratio - 1)
+                    if res[name]['time'] < MIN_COMPARED_TIME:
+                        flag = '({})'.format(flag)
+                        ratio = 1.
+                    # allocations of less than 1 MB more are not reported
+                    if ratio > 1 + args.tolerance \
+                            or entry['peak_mb'] > ref['peak_mb'] \
+                            * (1 + args.tolerance) + 1:
+                        flag += ' REGRESSION'
+                        regressions += 1
+                print('{:<30} {:<10} {:>10.2f} {:>10.1f} {:>10}'.format(
+                     key, name, entry['us_per_record'], entry['peak_mb'],
+                     flag))
+
+    if args.save is not None:
+        with open(args.save, 'w', encoding='utf8') as fid:
+            json.dump({'version': c2h.__version__,
+                       'python': sys.version.split()[0],
+                       'machine': machine(),
+                       'results': results},
+                      fid, sort_keys=True, indent=1)
+        print('=> Baseline saved to {}'.format(args.save))
+    if regressions > 0:
+        print('=> {} regressions (tolerance {:.0%})'.format(regressions,
+                                                            args.tolerance))
+    return regressions
+
+
+def check_outputs(tmp_dir):
+    ''' Convert generated files to tmp_dir/out, with the cases of past bugs:
+    categories in the QIF, CRLF line ends, files found from their content
+    or not converted, duplicates of renamed files and bytes. Returns the
+    (output, expected file name) pairs. '''
+    in_dir = os.path.join(tmp_dir, 'in')
+    out_dir = os.path.join(tmp_dir, 'out')
+    os.mkdir(in_dir)
+    os.mkdir(out_dir)
+    pair_l = []
+
+    def convert(session, source, base, expected=None):
+        out_l = [os.path.join(out_dir, base + ext) for ext in ('.qif', '.csv')]
+        session.convert(source, out_l[0], out_l[1])
+        for out_file in out_l:
+            pair_l.append((out_file, (expected or base) + out_file[-4:]))
+
+    in_d = {}
+    for typ in sorted(generators.keys()):
+        gen, name = generators[typ]
+        in_d[typ] = os.path.join(in_dir, name)
+        gen(in_d[typ], CHECK_RECORDS)
+    with open(in_d['Boursorama_qif'], 'rb') as fid:
+        qif = fid.read()
+    with open(in_d['INGDiba_csv'], 'rb') as fid:
+        ing = fid.read()
+    # quick2000 exports (_R) have the header of the Q ones but are skipped
+    for name, data in [('00000000000_Q20141231_crlf.qif',
+                        qif.replace(b'\n', b'\r\n')),
+                       ('00000000000_R20141231.qif', qif),
+                       ('renamed.qif', qif),
+                       ('renamed.csv', ing),
+                       ('renamed_copy.csv', ing),
+                       ('sparkasse.csv', SPARKASSE_CSV.encode('cp1252'))]:
+        in_d[name] = os.path.join(in_dir, name)
+        with open(in_d[name], 'wb') as fid:
+            fid.write(data)
+
+    types = os.path.join(out_dir, 'types.txt')
+    with open(types, 'w', encoding='utf8', newline='') as fid:
+        for name in sorted(os.listdir(in_dir)):
+            fid.write('{}\t{}\n'.format(
+                name, c2h.detect_type(os.path.join(in_dir, name))))
+    pair_l.append((types, 'types.txt'))
+
+    session = c2h.ConversionSession()
+    for typ in sorted(generators.keys()):
+        convert(session, in_d[typ], typ)
+    # same outputs as with '\n' line ends
+    convert(session, in_d['00000000000_Q20141231_crlf.qif'], 'crlf',
+            'Boursorama_qif')
+    session = c2h.ConversionSession(categories=CHECK_CATEGORIES)
+    for typ in ['Boursorama_qif', 'INGDiba_csv']:
+        convert(session, in_d[typ], 'categories_' + typ)
+    # the account of renamed files and bytes is their type: the copies are
+    # dropped
+    with c2h.ConversionSession(dedup_index=os.path.join(tmp_dir,
+                                                        'index')) as session:
+        convert(session, in_d['renamed.csv'], 'dedup_renamed')
+        convert(session, in_d['renamed_copy.csv'], 'dedup_renamed_copy')
+        convert(session, qif, 'dedup_bytes')
+        convert(session, in_d['renamed.qif'], 'dedup_renamed_qif')
+    return pair_l
+
+
+def bench_check(args, tmp_dir):
+    ''' Outputs of generated files compared to the expected ones '''
+    pair_l = check_outputs(tmp_dir)
+    written = set()
+    differences = 0
+    for out_file, expected in pair_l:
+        ref = os.path.join(EXPECTED_DIR, expected)
+        if args.update and expected not in written:
+            if not os.path.isdir(EXPECTED_DIR):
+                os.makedirs(EXPECTED_DIR)
+            shutil.copyfile(out_file, ref)
+            written.add(expected)
+        elif not os.path.isfile(ref) \
+                or not filecmp.cmp(out_file, ref, shallow=False):
+            print('check: {} differs from {}'.format(
+                os.path.basename(out_file), ref))
+            differences += 1
+    print('{:<40} {:>8} files {:>6} differences'.format(
+        'check: converted outputs', len(pair_l), differences))
+    if args.update:
+        print('=> Expected outputs written to {}'.format(EXPECTED_DIR))
+    return differences
+
+
+benchmarks = {'rules': bench_rules,
+              'ing': bench_ing,
+              'writer': bench_writer,
+              'suite': bench_suite,
+              'check': bench_check,
+              }
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING,
+                        format='[%(levelname)-5s] %(lineno)s - %(message)s')
+
+    p = argparse.ArgumentParser()
+    p.add_argument('bench', nargs='*',
+                   help="benchmarks to run among {} (default: all)"\
+                        .format(', '.join(sorted(benchmarks.keys()))))
+    p.add_argument('-n', type=int, default=10000,
+                   help="number of records")
+    p.add_argument('--sizes', default='1000,100000,1000000',
+                   help="numbers of records of the suite")
+    p.add_argument('--baseline', default='bench_baseline.json',
+                   help="results the suite is compared to")
+    p.add_argument('--save', help="save the results of the suite to a file")
+    p.add_argument('--tolerance', type=float, default=0.25,
+                   help="relative increase reported as a regression")
+    p.add_argument('--repeat', type=int, default=3,
+                   help="timings of each phase of the suite, the best is"
+                   " kept")
+    p.add_argument('--update', action='store_true',
+                   help="write the outputs of check as the expected ones")
+    p.add_argument('--generate', metavar='DIR',
+                   help="only write a file of n records of each format to DIR")
+    args = p.parse_args()
+    args.sizes = [int(n) for n in args.sizes.split(',')]
+    for name in args.bench:
+        if name not in benchmarks:
+            p.error('unknown benchmark {}'.format(name))
+
+    if args.generate is not None:
+        for typ in sorted(generators.keys()):
+            gen, name = generators[typ]
+            gen(os.path.join(args.generate, name), args.n)
+        return
+
+    regressions = 0
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in args.bench or sorted(benchmarks.keys()):
+            regressions += benchmarks[name](args, tmp_dir) or 0
+    finally:
+        shutil.rmtree(tmp_dir)
+    if regressions > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
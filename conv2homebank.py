@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Author: Pierre
 # Purpose: process files exported from bank website to inport in HomeBank
@@ -12,10 +12,9 @@
 
 # Rq: CSV output has more info
 
-# Todo: fix unicode issues with french and german characters
-
-from __future__ import absolute_import
-from __future__ import unicode_literals  # all strings in this file are unicode
+# Files are read and written as text with their encoding (cp1252 for ING,
+# UTF-16 for Linxo, UTF-8 for the outputs): fields are never decoded one
+# by one.
 
 import sys
 import os
@@ -24,13 +23,44 @@ import re
 import time
 import csv
 import json
+import hashlib
+import heapq
+import mmap
 import tempfile
 import argparse
+import codecs
+import contextlib
+import io
+import importlib
+import cProfile
+import pstats
+from collections import Counter, OrderedDict
+from array import array
+from datetime import date, datetime
+import multiprocessing
 from os.path import isfile, join
+from xml.etree import ElementTree
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
-from codecs import open
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__version__ = '0.4'
 
 logger = logging.getLogger(__name__)
+# logging is configured by main(), or by the application using the module
+logger.addHandler(logging.NullHandler())
 
 # Payment modes handled by HomeBank (csv codes)
 PAYMODES = ["None",  # 0
@@ -45,17 +75,610 @@ PAYMODES = ["None",  # 0
             "Deposit",  # 9
             "FI Fees"]  # 10
 
+
+
+class FileFormat:
+    ''' A type of bank export: file name pattern (the account number, when
+    present, is captured as "account"), encoding, signature (text found at
+    the start of the files) and parser. The parser is given by name, a class
+    of this script or "module:attr", and imported on first use. '''
+    def __init__(self, name, pattern, parser=None, encoding=None,
+                 signature=None, qif_head=False, complete=True):
+        self.name = name
+        self.pattern = pattern
+        self.parser = parser
+        self.encoding = encoding
+        self.signature = signature
+        # only QIF parsers provide the header of the QIF file
+        self.qif_head = qif_head
+        self.complete = complete
+        self._parser_class = None
+
+    def get_parser(self):
+        ''' Parser class, imported the first time it is needed '''
+        if self._parser_class is None and self.parser is not None:
+            module, _, attr = self.parser.rpartition(':')
+            if module == '':
+                self._parser_class = globals()[attr]
+            else:
+                self._parser_class = getattr(importlib.import_module(module),
+                                             attr)
+        return self._parser_class
+
+
+class FormatRegistry:
+    ''' The supported types of files, in order of detection. File names are
+    matched against one regular expression combining all the patterns. '''
+    def __init__(self):
+        self.formats = OrderedDict()
+        self.regex = None
+        self.order = []
+
+    def register(self, fmt):
+        self.formats[fmt.name] = fmt
+        self.regex = None
+
+    def __contains__(self, name):
+        return name in self.formats
+
+    def __getitem__(self, name):
+        return self.formats[name]
+
+    def names(self):
+        return list(self.formats.keys())
+
+    def can_convert(self, name):
+        return name in self.formats and self.formats[name].parser is not None
+
+    def match(self, file_name):
+        ''' (format, match of its pattern) of file_name, (None, None) if no
+        format matches '''
+        if self.regex is None:
+            self.order = list(self.formats.values())
+            self.regex = re.compile('|'.join(
+                prefix_groups(fmt.pattern, 'f{}'.format(idx))
+                for idx, fmt in enumerate(self.order)), re.UNICODE)
+        m = self.regex.match(file_name)
+        if m is None:
+            return None, None
+        # the format group encloses the others, it is the last one closed
+        return self.order[int(m.lastgroup[1:])], m
+
+    def sniff(self, head):
+        ''' First convertible format whose signature is found in head (the
+        first bytes of a file) decoded with its encoding, None if none '''
+        for fmt in self.formats.values():
+            if fmt.parser is None or fmt.signature is None:
+                continue
+            text = head.decode(fmt.encoding or 'utf8', 'replace')
+            if fmt.signature in text.lstrip('\ufeff'):
+                return fmt
+        return None
+
+
 # for automatic detection of files in "In" directory and automatic processing
-filetypes = {'INGDiba_csv': r'Umsatzanzeige_[0-9]{10}_[0-9]{8}.*.csv',
-             'Boursorama_qif': r'[0-9]{11}_Q[0-9]{8}.*.qif',
-             'Boursorama_quick2000': r'[0-9]{11}_R[0-9]{8}.*.qif',
-             'Linxo_csv': r'op\xe9rations.csv'
-             }
+formats = FormatRegistry()
+formats.register(FileFormat(
+    'INGDiba_csv', r'Umsatzanzeige_(?P<account>[0-9]{10})_[0-9]{8}.*.csv',
+    'ING_DiBa_csv_file', encoding='cp1252', signature='Buchung;Valuta;'))
+formats.register(FileFormat(
+    'Boursorama_qif', r'(?P<account>[0-9]{11})_Q[0-9]{8}.*.qif',
+    'boursorama_qif_file', encoding='cp1252', signature='!Type:',
+    qif_head=True))
+formats.register(FileFormat(
+    'Boursorama_quick2000', r'(?P<account>[0-9]{11})_R[0-9]{8}.*.qif',
+    encoding='cp1252', signature='!Type:'))
+formats.register(FileFormat(
+    'Linxo_csv', r'op\xe9rations.csv', 'linox_csv_file',
+    encoding='utf-16', signature='Date\tLibell', complete=False))
+
+# columns of at least this many amounts are parsed with NumPy, if installed
+BATCH_MIN_SIZE = 1000
+
+# decoding error handler of the input files, see count_encoding_error
+ENCODING_ERRORS = 'conv2homebank'
+
+# bytes read from the start of a file to find its type from its content
+SNIFF_SIZE = 4096
+
+# conversion state of the "In" directory, saved in "Out"
+MANIFEST = '.conv2homebank.json'
+# fingerprints of the exported operations, saved in "Out"
+DEDUP_INDEX = '.conv2homebank_index'
+# all the operations of the "In" directory, with --consolidate
+CONSOLIDATED_CSV = 'consolidated.csv'
+
+# CSV columns expected by HomeBank
+# (filled with the fields date, paymode, info, payee, memo, amount,
+# category, tags of the records)
+CSV_HEAD = ['date', 'paymode', 'info', 'payee', 'wording',
+            'amount', 'category', 'tags']
+
+
+# Date formats read by slicing: format -> (day, month, year, year length,
+# separators); 2-digit years are in the 2000s (Boursorama: 12/31'14)
+DATE_FORMATS = {'%d.%m.%Y': (0, 3, 6, 4, '..'),
+                '%d/%m/%Y': (0, 3, 6, 4, '//'),
+                '%m/%d/%Y': (3, 0, 6, 4, '//'),
+                "%m/%d'%y": (3, 0, 6, 2, "/'"),
+                }
+# Statements only contain a few hundred distinct dates: the conversions are
+# cached, the caches are emptied when they reach DATE_CACHE_SIZE entries
+DATE_CACHE_SIZE = 10000
+_day_cache = {}
+_date_cache = {}
+
+
+def parse_day(s, fmt):
+    ''' Day number (proleptic Gregorian ordinal) of a date string '''
+    layout = DATE_FORMATS.get(fmt)
+    if layout is not None:
+        idx_d, idx_m, idx_y, len_y, sep = layout
+        if len(s) == idx_y + len_y and s[2] == sep[0] and s[5] == sep[1]:
+            year = int(s[idx_y:])
+            if len_y == 2:
+                year += 2000
+            return date(year, int(s[idx_m:idx_m + 2]),
+                        int(s[idx_d:idx_d + 2])).toordinal()
+    return datetime.strptime(s, fmt).toordinal()
+
+
+def day_ordinal(s, fmt):
+    ''' Day number of a date string, cached '''
+    key = (s, fmt)
+    day = _day_cache.get(key)
+    if day is None:
+        day = parse_day(s, fmt)
+        if len(_day_cache) >= DATE_CACHE_SIZE:
+            _day_cache.clear()
+        _day_cache[key] = day
+    return day
+
+
+def format_day(day):
+    ''' Date of a day number as expected by HomeBank (mm/dd/yyyy), cached.
+    Day numbers have no time zone: a date is the same when read and
+    written. '''
+    s = _date_cache.get(day)
+    if s is None:
+        d = date.fromordinal(day)
+        s = '{:02d}/{:02d}/{:04d}'.format(d.month, d.day, d.year)
+        if len(_date_cache) >= DATE_CACHE_SIZE:
+            _date_cache.clear()
+        _date_cache[day] = s
+    return s
+
+
+def parse_cents(s, decimal_sep='.', thousands_sep=''):
+    ''' Integer number of cents of an amount string (e.g. "-1.234,56" with
+    decimal_sep "," and thousands_sep "."), without going through a float.
+    Digits after the cents are rounded half away from zero. '''
+    s = s.strip(' "')
+    if thousands_sep != '':
+        s = s.replace(thousands_sep, '')
+    whole, _, frac = s.partition(decimal_sep)
+    if len(frac) == 2:
+        # int() checks the digits and takes the sign
+        return int(whole + frac)
+    if whole.lstrip('+-') + frac == '' or not frac[2:].isdigit() \
+            and len(frac) > 2:
+        raise ValueError('invalid amount: {!r}'.format(s))
+    cents = int(whole + (frac + '00')[:2])
+    if frac[2:3] >= '5':
+        cents += -1 if whole.startswith('-') else 1
+    return cents
+
+
+def _parse_cents_numpy(values, decimal_sep, thousands_sep):
+    ''' parse_cents of a list of strings, reading the characters of all the
+    values a column at a time. None if some value is not a plain amount. '''
+    arr = numpy.array(values)
+    if arr.dtype.kind not in 'SU' or arr.dtype.itemsize == 0:
+        return None
+    codes = arr.view(numpy.uint32 if arr.dtype.kind == 'U' else numpy.uint8)
+    codes = numpy.asfortranarray(codes.reshape(len(values), -1))
+    n = len(values)
+    whole = numpy.zeros(n, numpy.int64)
+    frac = numpy.zeros(n, numpy.int64)
+    n_frac = numpy.zeros(n, numpy.int64)
+    rounding = numpy.zeros(n, bool)
+    in_frac = numpy.zeros(n, bool)
+    seen_digit = numpy.zeros(n, bool)
+    neg = numpy.zeros(n, bool)
+    invalid = numpy.zeros(n, bool)
+    # padding, spaces and quotes are skipped, like the thousands separators
+    skipped = [0, 32, 34] + [ord(c) for c in thousands_sep]
+    for j in range(codes.shape[1]):
+        c = codes[:, j].astype(numpy.int64)
+        digit = c - 48
+        is_digit = (digit >= 0) & (digit <= 9)
+        is_dec = c == ord(decimal_sep)
+        is_sign = (c == 43) | (c == 45)
+        known = is_digit | is_dec | is_sign
+        for code in skipped:
+            known |= c == code
+        invalid |= (is_dec & in_frac) | (is_sign & seen_digit) | ~known
+        whole = numpy.where(is_digit & ~in_frac, whole * 10 + digit, whole)
+        in_cents = is_digit & in_frac & (n_frac < 2)
+        frac = numpy.where(in_cents, frac * 10 + digit, frac)
+        rounding |= is_digit & in_frac & (n_frac == 2) & (digit >= 5)
+        n_frac += is_digit & in_frac
+        in_frac |= is_dec
+        seen_digit |= is_digit
+        neg |= c == 45
+    if invalid.any() or not seen_digit.all() or codes.shape[1] > 18:
+        return None
+    cents = whole * 100 + frac * 10 ** (2 - numpy.minimum(n_frac, 2)) \
+        + rounding
+    return numpy.where(neg, -cents, cents).tolist()
+
+
+def parse_cents_column(values, decimal_sep='.', thousands_sep=''):
+    ''' parse_cents of each string of values. Large columns are parsed at
+    once with NumPy when it is installed. '''
+    if numpy is not None and len(values) >= BATCH_MIN_SIZE:
+        cents_l = _parse_cents_numpy(values, decimal_sep, thousands_sep)
+        if cents_l is not None:
+            return cents_l
+    return [parse_cents(s, decimal_sep, thousands_sep) for s in values]
+
+
+def format_cents(cents):
+    ''' Amount string (e.g. -12.50) of a number of cents '''
+    sign = '-' if cents < 0 else ''
+    return '{}{}.{:02d}'.format(sign, abs(cents) // 100, abs(cents) % 100)
+
+
+class HBRecord:
+    ''' One HomeBank operation.
+    The date is kept as a day ordinal and the amount as integer cents. '''
+    __slots__ = ('day', 'paymode', 'info', 'payee', 'memo', 'cents',
+                 'category', 'tags')
+
+    def __init__(self, day, paymode=0, info=None, payee=None, memo=None,
+                 cents=0, category=None, tags=None):
+        self.day = day
+        self.paymode = paymode
+        self.info = info
+        self.payee = payee
+        self.memo = memo
+        self.cents = cents
+        self.category = category
+        self.tags = tags
+
+    @property
+    def date(self):
+        ''' Date as expected by HomeBank (mm/dd/yyyy) '''
+        return format_day(self.day)
+
+    @property
+    def amount(self):
+        return format_cents(self.cents)
+
+    def to_list(self):
+        return [getattr(self, item) for item in self.__slots__]
+
+
+class TransactionStore:
+    ''' Operations of a file ordered by day.
+    Days are stored in an array next to the list of operations; operations
+    of the same day keep their insertion order. '''
+    def __init__(self):
+        self.days = array('l')
+        self.ops = []
+        self.strings = {}
+        self.order = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def add(self, day, op):
+        self.days.append(day)
+        self.ops.append(op)
+        self.order = None
+
+    def intern(self, s):
+        ''' Share identical strings (payees repeat a lot) '''
+        return self.strings.setdefault(s, s)
+
+    def items(self):
+        ''' (day, operation) pairs sorted by day '''
+        if self.order is None:
+            # sort is stable: same-day operations stay in insertion order
+            self.order = sorted(range(len(self.days)),
+                                key=self.days.__getitem__)
+        for idx in self.order:
+            yield self.days[idx], self.ops[idx]
+
+    def __iter__(self):
+        for day, op in self.items():
+            yield op
+
+
+class Metrics:
+    ''' Timers (s) of the phases and counters of a conversion.
+    Timers nest: the time of an inner phase is not counted in the outer one,
+    so the phases of interleaved generators (stream mode) add up. '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timers = Counter()
+        self.counters = Counter()
+        self.stack = []
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def start(self, name):
+        self.stack.append([name, time.time(), 0.])
+
+    def stop(self):
+        name, t0, inner = self.stack.pop()
+        elapsed = time.time() - t0
+        self.timers[name] += elapsed - inner
+        if len(self.stack) > 0:
+            self.stack[-1][2] += elapsed
+
+    def timed(self, name, items):
+        ''' Iterate over items, the time spent producing them going to name '''
+        it = iter(items)
+        while True:
+            self.start(name)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            yield item
+
+    def to_dict(self):
+        return {'timers': dict(self.timers), 'counters': dict(self.counters)}
+
+
+# instrumentation of the file being converted, reset by run_task
+metrics = Metrics()
+
+
+# Classification of the Boursorama descriptions, the first matching rule wins.
+# pattern: matched at the start of the description; its named groups and
+#          "descr" (the whole description) can be used in the templates
+# type, payee, info: templates of the parsed fields
+# paymode: name of the payment mode in PAYMODES, None for no payment mode
+_CARD = r' *(?P<date>[0-9]{6})\s*(?P<lieu>[A-Z0-9]{2})(?P<payee>.*)'
+BOURSORAMA_RULES = [
+    {'pattern': r' *(?P<type>PAIEMENT CARTE)' + _CARD,
+     'paymode': 'Credit Card', 'info': 'CB'},
+    {'pattern': r'(?P<type>[A-Z \.]*VIR[A-Z \.]*?)' + _CARD,
+     'paymode': 'Transfer'},
+    {'pattern': r'(?P<type>[A-Z \.]*PRLV[A-Z \.]*?)' + _CARD,
+     'paymode': 'Standing Order'},
+    {'pattern': r'(?P<type>[A-Z \.]*RETRAIT[A-Z \.]*?)' + _CARD,
+     'paymode': None},
+    {'pattern': r'(?P<type>[A-Z \.]*?)' + _CARD},
+    {'pattern': r'(?P<before>.*?)VIR SEPA ?(?P<after>.*)',
+     'type': 'VIR SEPA', 'payee': '{before}{after}', 'paymode': 'Transfer'},
+    {'pattern': r'(?P<before>.*?)PRLV SEPA ?(?P<after>.*)',
+     'type': 'PRLV SEPA', 'payee': '{before}{after}',
+     'paymode': 'Standing Order'},
+    {'pattern': r'.*?CHQ(?:.*?N\.(?P<cheque>.*))?',
+     'type': 'CHQ.', 'paymode': 'Check', 'info': '{cheque}'},
+    {'pattern': r'.*?RETRAIT DAB', 'type': 'RETRAIT', 'paymode': None},
+    {'pattern': r'.*?VIR', 'type': 'VIR', 'paymode': 'Transfer'},
+    {'pattern': r'.*?PRLV', 'type': 'PRLV', 'paymode': 'Standing Order'},
+    {'pattern': r'.*?Relev(?:.*?(?P<carte>Carte.*))?',
+     'type': 'Releve Carte', 'payee': 'Relev\xe9 diff\xe9r\xe9 {carte}'},
+    ]
+
+
+def prefix_groups(pattern, name):
+    ''' pattern enclosed in a group name, its groups prefixed with "name_"
+    so that several patterns can be combined into one alternation '''
+    pattern = re.sub(r'\(\?P<(\w+)>', r'(?P<{}_\1>'.format(name), pattern)
+    return '(?P<{}>{})'.format(name, pattern)
+
+
+class RuleEngine:
+    ''' Ordered classification rules (see BOURSORAMA_RULES), compiled once
+    into a single regular expression: one match classifies a description '''
+    def __init__(self, rules):
+        self.rules = rules
+        self.actions = []
+        part_l = []
+        for idx, rule in enumerate(rules):
+            # prefix the groups with the rule name to keep them unique
+            part_l.append(prefix_groups(rule['pattern'],
+                                        'r{}'.format(idx)))
+            paymode = rule.get('paymode', 'None')
+            if paymode is not None:
+                paymode = PAYMODES.index(paymode)
+            self.actions.append((rule.get('type', '{type}'),
+                                 rule.get('payee', '{payee}'),
+                                 rule.get('info'),
+                                 paymode))
+        try:
+            self.regex_l = [re.compile('|'.join(part_l), re.UNICODE)]
+        except (AssertionError, re.error):
+            # too many groups for this version of python: one regex per rule
+            self.regex_l = [re.compile(part, re.UNICODE) for part in part_l]
+        self.group_d = {}
+        for regex in self.regex_l:
+            for full in regex.groupindex:
+                name, _, short = full.partition('_')
+                self.group_d.setdefault(name, []).append((full, short))
+
+    def classify(self, descr):
+        ''' Parsed fields of descr, None if no rule matches '''
+        for regex in self.regex_l:
+            m = regex.match(descr)
+            if m is not None:
+                break
+        else:
+            return None
+        # the rule group encloses the others, it is the last one closed
+        rule_type, payee, info, paymode = self.actions[int(m.lastgroup[1:])]
+        fields = {'descr': descr, 'type': '', 'payee': descr}
+        for full, short in self.group_d[m.lastgroup]:
+            if short != '':
+                fields[short] = m.group(full) or ''
+        return {'type': rule_type.format(**fields).strip(),
+                'Descr': payee.format(**fields).strip(),
+                'info': None if info is None else info.format(**fields).strip(),
+                'paymode': paymode}
+
+
+def load_rules(path):
+    ''' Read a list of rules from a JSON file (or YAML, if PyYAML is
+    installed) '''
+    with open(path, encoding='utf8') as fid:
+        if path.endswith('.yml') or path.endswith('.yaml'):
+            if yaml is None:
+                raise ValueError('PyYAML is needed to read {}'.format(path))
+            return yaml.safe_load(fid)
+        return json.load(fid)
+
+
+def date_field(fmt):
+    ''' CSV field converter: date in format fmt to day ordinal '''
+    def convert(field):
+        return day_ordinal(field.strip(' "'), fmt)
+    return convert
+
+
+def cents_field(decimal_sep=',', thousands_sep='.'):
+    ''' CSV field converter: amount (1.234,56 by default) to integer cents '''
+    def convert(field):
+        return parse_cents(field, decimal_sep, thousands_sep)
+    return convert
+
+
+def parse_amount_columns(op_l, columns, decimal_sep=',', thousands_sep='.'):
+    ''' Replace the amount strings of columns by integer cents in the
+    operations of op_l, a column at a time '''
+    for name in columns:
+        cents_l = parse_cents_column([op_d[name] for op_d in op_l],
+                                     decimal_sep, thousands_sep)
+        for op_d, cents in zip(op_l, cents_l):
+            op_d[name] = cents
+
+
+def raw_field(field):
+    ''' CSV field converter: field as read '''
+    return field
+
+
+def text_field(field):
+    ''' CSV field converter: text without trailing spaces '''
+    return field.rstrip(' ')
+
+
+class CsvRowDecoder:
+    ''' Converts the rows of a CSV file to dicts indexed by the header.
+    The column index and converter of each field are looked up once from the
+    header; converters maps column names to functions taking the raw field,
+    the other columns use default. '''
+    def __init__(self, headerline, converters, default=text_field):
+        self.headerline = headerline
+        self.columns = []
+        for idx, name in enumerate(headerline):
+            # a repeated column (e.g. currency) takes its first value
+            if name not in headerline[:idx]:
+                self.columns.append((name, idx,
+                                     converters.get(name, default)))
+
+    def __call__(self, row):
+        sub_d = {}
+        for name, idx, convert in self.columns:
+            sub_d[name] = convert(row[idx])
+        return sub_d
+
+    def present(self, names):
+        ''' The names which are columns of the header, in the order of names '''
+        header = set(name for name, idx, convert in self.columns)
+        return [name for name in names if name in header]
+
+
+def count_encoding_error(exc):
+    ''' Decoding error handler: the undecodable bytes are counted, logged and
+    replaced by U+FFFD, the rest of the file is read '''
+    metrics.count('encoding_errors')
+    logger.error('! Encoding error: {}'.format(exc))
+    return '\ufffd', exc.end
+
+
+codecs.register_error(ENCODING_ERRORS, count_encoding_error)
+
+
+def is_path(in_file):
+    ''' True for a file name, False for bytes and file objects '''
+    return isinstance(in_file, (str, os.PathLike))
+
+
+def source_name(in_file):
+    ''' Name of an input or output in the messages '''
+    if is_path(in_file):
+        return os.fspath(in_file)
+    return getattr(in_file, 'name', '<{}>'.format(type(in_file).__name__))
+
+
+@contextlib.contextmanager
+def open_text(in_file, encoding):
+    ''' Text stream of in_file (file name, bytes or binary file object)
+    decoded with encoding. File objects are left open. '''
+    if is_path(in_file):
+        with open(in_file, encoding=encoding, errors=ENCODING_ERRORS,
+                  newline='') as fid:
+            yield fid
+        return
+    if isinstance(in_file, (bytes, bytearray)):
+        in_file = io.BytesIO(in_file)
+    fid = io.TextIOWrapper(in_file, encoding=encoding,
+                           errors=ENCODING_ERRORS, newline='')
+    try:
+        yield fid
+    finally:
+        fid.detach()
+
+
+@contextlib.contextmanager
+def open_buffer(in_file):
+    ''' Content of in_file as bytes: file names are mapped in memory, file
+    objects are read '''
+    if isinstance(in_file, (bytes, bytearray)):
+        yield in_file
+        return
+    if not is_path(in_file):
+        yield in_file.read()
+        return
+    with open(in_file, 'rb') as fid:
+        if os.fstat(fid.fileno()).st_size == 0:
+            yield b''
+            return
+        mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield mm
+    finally:
+        mm.close()
+
+
+def read_head(in_file, size=SNIFF_SIZE):
+    ''' First size bytes of in_file; file objects are read from their
+    position, which is restored '''
+    if isinstance(in_file, (bytes, bytearray)):
+        return bytes(in_file[:size])
+    if is_path(in_file):
+        with open(in_file, 'rb') as fid:
+            return fid.read(size)
+    pos = in_file.tell()
+    head = in_file.read(size)
+    in_file.seek(pos)
+    return head
 
 
 def dispdic(in_d):
-    print json.dumps(in_d, sort_keys=True,
-                     indent=4, separators=(',', ': '))
+    print(json.dumps(in_d, sort_keys=True,
+                     indent=4, separators=(',', ': ')))
 
 
 def listExtFromDir(ext, in_dir):
@@ -67,57 +690,106 @@ def listExtFromDir(ext, in_dir):
 class boursorama_qif_file:
     """ Handles the QIF files from boursorama output
     Data representation of internal dict is messy... """
-    def __init__(self, in_file):
+    # classification of the descriptions, shared by all files
+    rules = RuleEngine(BOURSORAMA_RULES)
+    encoding = 'cp1252'
+
+    def __init__(self, in_file, stream=False, rules=None):
+        if rules is not None:
+            # rule engine of the caller instead of the shared one
+            self.rules = rules
+        if not is_path(in_file) and not isinstance(in_file,
+                                                   (bytes, bytearray)):
+            # file objects are read once, the header and records are then
+            # taken from their content
+            in_file = in_file.read()
         self.in_file = in_file
-        self.op_d = {}
+        self.op_d = TransactionStore()
         self.headerline = None
 
-        self.open_qif()
-        self.process_op()
+        if stream:
+            # records are read on demand by iter_HB()
+            with open_buffer(self.in_file) as mm:
+                self.read_header(mm)
+        else:
+            self.open_qif()
+            self.process_op()
 
     def open_qif(self):
-        logger.info('* opening {}'.format(self.in_file))
-        with open(self.in_file, 'rb') as fid:
-            self.headerline = fid.readline().replace('Ccard', 'CCard')
-            fbuff = fid.read()
-
-        # Replace weird chars
-#         fbuff = re.sub(u"\u007B", u"\xe9", fbuff)
-#         fbuff = re.sub(u"\u00C2\u00A0", "", fbuff)
-
-        op_l = fbuff.split('^')
-        self.op_d = self.read_op_l(op_l)
-
-    def read_op_l(self, op_l):
-        logger.debug('=> {} operations in file.'.format(len(op_l)))
-        out_d = {}
-        for op in op_l:
+        logger.info('* opening {}'.format(source_name(self.in_file)))
+        self.op_d = self.read_op_l(self.iter_op())
+
+    def iter_op_l(self):
+        ''' Yield the text of each record. The file is mapped in memory and
+        only the current record is copied from it and decoded. '''
+        with open_buffer(self.in_file) as mm:
+            for start, end in self.iter_bounds(mm, self.read_header(mm)):
+                yield self.decode(mm[start:end])
+
+    def read_header(self, mm):
+        ''' Read the first line of mm, return the offset of the next one '''
+        end = mm.find(b'\n') + 1 or len(mm)
+        # the QIF files are written with '\n' line ends
+        self.headerline = self.decode(mm[:end]).replace('Ccard', 'CCard')\
+                              .replace('\r\n', '\n')
+        return end
+
+    def decode(self, data):
+        return data.decode(self.encoding, ENCODING_ERRORS)
+
+    @staticmethod
+    def iter_bounds(mm, pos):
+        ''' Yield the (start, end) offsets of the records of mm from pos.
+        Records end with a line starting with '^', the text after the last
+        one is a record if it is not blank. '''
+        size = len(mm)
+        while pos < size:
+            if mm[pos:pos + 1] == b'^':
+                end = pos
+            else:
+                end = mm.find(b'\n^', pos)
+                if end == -1:
+                    if mm[pos:].strip(b'\r\n') != b'':
+                        yield pos, size
+                    return
+                end += 1
+            yield pos, end
+            # skip the '^' line
+            pos = mm.find(b'\n', end) + 1 or size
+
+    def iter_op(self):
+        ''' Yield the operations of the file one at a time '''
+        for op in metrics.timed('read', self.iter_op_l()):
             op_d = self.read_op(op.rstrip('\n').lstrip('\n'))
             if len(op_d) > 1:
-                ts = time.strptime(op_d['Date'], '%m/%d/%Y')
-                ts = int(time.mktime(ts))
-                while ts in out_d:
-                    ''' If another record with the same timestamp exists,
-                    add 1 sec since the timestamp will be used as
-                    dictionnary key'''
-                    ts += 1
-                out_d[ts] = op_d
+                metrics.count('parsed')
+                yield op_d
             else:
+                metrics.count('empty')
                 logger.error('! Empty record ?')
                 logger.error('! => {}'.format(op_d))
+
+    def read_op_l(self, op_l):
+        out_d = TransactionStore()
+        for op_d in op_l:
+            out_d.add(op_d['Date'], op_d)
+        logger.debug('=> {} operations in file.'.format(len(out_d)))
         return out_d
 
     def read_op(self, op_l):
 #         logger.debug('\t* {}'.format(op_l.replace('\n', '\t|')))
         op_d = {}
+        # CRLF exports: the '\r' ends the fields otherwise
         l = op_l.split('\n')
 
         for item in l:
+            item = item.rstrip('\r')
             if len(item) > 0:
                 if item[0] == 'D':
-                    op_d['Date'] = item[1:].replace("'", "/20")
+                    op_d['Date'] = day_ordinal(item[1:], "%m/%d'%y"
+                                               if "'" in item else '%m/%d/%Y')
                 elif item[0] == 'T':
-                    op_d['Montant'] = float(item[1:].replace(',', ''))
+                    op_d['Montant'] = parse_cents(item[1:], '.', ',')
                 elif item[0] == 'P':
                     op_d['Descr'] = item[1:]
                 else:
@@ -128,371 +800,1454 @@ class boursorama_qif_file:
         return op_d
 
     def process_op(self):
-        for key in sorted(self.op_d.keys()):
-            l1 = re.match(r'^([A-Z \.]*)([0-9]{6})\s*([A-Z0-9]{2})(.*)',
-                          self.op_d[key]['Descr'])
-            self.op_d[key]['Parse'] = {}
-            self.op_d[key]['Parse']['date'] = self.op_d[key]['Date']\
-                                                        .replace('/', '')
-            self.op_d[key]['Parse']['lieu'] = ''
-            if l1 != None:
-                self.op_d[key]['Parse']['type'] = l1.group(1).rstrip(' ')\
-                                                             .lstrip(' ')
-                self.op_d[key]['Parse']['date'] = l1.group(2).rstrip(' ')\
-                                                             .lstrip(' ')
-                self.op_d[key]['Parse']['lieu'] = l1.group(3).rstrip(' ')\
-                                                             .lstrip(' ')
-                self.op_d[key]['Parse']['Descr'] = l1.group(4).rstrip(' ')\
-                                                              .lstrip(' ')
-            elif self.op_d[key]['Descr'].find('VIR SEPA') != -1:
-                self.op_d[key]['Parse']['type'] = 'VIR SEPA'
-                self.op_d[key]['Parse']['Descr'] = self.op_d[key]['Descr']\
-                                                    .replace('VIR SEPA ', '')
-            elif self.op_d[key]['Descr'].find('PRLV SEPA') != -1:
-                self.op_d[key]['Parse']['type'] = 'PRLV SEPA'
-                self.op_d[key]['Parse']['Descr'] = self.op_d[key]['Descr']\
-                                                    .replace('PRLV SEPA ', '')
-            elif self.op_d[key]['Descr'].find('CHQ') != -1:
-                self.op_d[key]['Parse']['type'] = 'CHQ.'
-                self.op_d[key]['Parse']['Descr'] = self.op_d[key]['Descr']
-                del1 = self.op_d[key]['Descr'].find('N.')
-                self.op_d[key]['Parse']['NrCheque'] = \
-                                            self.op_d[key]['Descr'][del1 + 2:]
-            elif self.op_d[key]['Descr'].find('RETRAIT DAB') != -1:
-                self.op_d[key]['Parse']['type'] = 'RETRAIT'
-                self.op_d[key]['Parse']['Descr'] = self.op_d[key]['Descr']
-            elif self.op_d[key]['Descr'].find('VIR') != -1:
-                self.op_d[key]['Parse']['type'] = 'VIR'
-                self.op_d[key]['Parse']['Descr'] = self.op_d[key]['Descr']
-            elif self.op_d[key]['Descr'].find('PRLV') != -1:
-                self.op_d[key]['Parse']['type'] = 'PRLV'
-                self.op_d[key]['Parse']['Descr'] = self.op_d[key]['Descr']
-            elif self.op_d[key]['Descr'].find('Relev') != -1:
-                self.op_d[key]['Parse']['type'] = 'Releve Carte'
-                del1 = self.op_d[key]['Descr'].find('Carte')
-                self.op_d[key]['Parse']['Descr'] = 'Relev\xe9 diff\xe9r\xe9 '\
-                                               + self.op_d[key]['Descr'][del1:]
-            else:
-                logger.error('! Ligne ignor\xe9e:')
-                logger.error('! {}'.format(self.op_d[key]['Descr']))
-                self.op_d[key]['Parse']['type'] = '?'
-                self.op_d[key]['Parse']['Descr'] = self.op_d[key]['Descr']
-
-    def dic2HBdic(self):
-        out_d = {}
+        for op_d in self.op_d:
+            self.parse_op(op_d)
+
+    def parse_op(self, op_d):
+        ''' Analyse the description of one operation '''
+        metrics.start('classify')
+        op_d['Parse'] = self.rules.classify(op_d['Descr'])
+        metrics.stop()
+        if op_d['Parse'] is None:
+            metrics.count('skipped')
+            logger.error('! Ligne ignor\xe9e:')
+            logger.error('! {}'.format(op_d['Descr']))
+            op_d['Parse'] = {'type': '?',
+                             'Descr': op_d['Descr'],
+                             'paymode': PAYMODES.index("None"),
+                             'info': None}
+
+    def op2HB(self, op_d):
+        ''' Convert one parsed operation to a HomeBank record '''
         # HB fields: date, paymode, info, payee, memo, amount, category, tags
+        return HBRecord(op_d['Date'],
+                        paymode=op_d['Parse']['paymode'],
+                        info=op_d['Parse']['info'],
+                        payee=op_d['Parse']['Descr'],
+                        memo=op_d['Descr'],
+                        cents=op_d['Montant'])
 
-        for item in self.op_d:
-            sub_d = {'date': self.op_d[item]['Date'],
-                     'paymode': PAYMODES.index("None"),
-                     'info': None,
-                     'payee': self.op_d[item]['Parse']['Descr'],
-                     'memo': self.op_d[item]['Descr'],
-                     'amount': self.op_d[item]['Montant'],
-                     'category': None,
-                     'tags': None}
-
-            if self.op_d[item]['Parse']['type'] == 'PAIEMENT CARTE':
-                sub_d['paymode'] = PAYMODES.index("Credit Card")
-                sub_d['info'] = 'CB'
-            elif self.op_d[item]['Parse']['type'].find('CHQ') != -1:
-                sub_d['paymode'] = PAYMODES.index("Check")
-                sub_d['info'] = self.op_d[item]['Parse']['NrCheque']
-            elif self.op_d[item]['Parse']['type'].find('VIR') != -1:
-                sub_d['paymode'] = PAYMODES.index("Transfer")
-            elif self.op_d[item]['Parse']['type'].find('PRLV') != -1:
-                sub_d['paymode'] = PAYMODES.index("Standing Order")
-            elif self.op_d[item]['Parse']['type'].find('RETRAIT') != -1:
-                sub_d['paymode'] = None
-                sub_d['info'] = None
-
-            out_d[item] = sub_d
+    def dic2HBdic(self):
+        out_d = TransactionStore()
+        for op_d in self.op_d:
+            rec = self.op2HB(op_d)
+            rec.payee = out_d.intern(rec.payee)
+            out_d.add(rec.day, rec)
         return out_d
 
+    def iter_HB(self):
+        ''' Yield HomeBank records one at a time, in file order '''
+        for op_d in self.iter_op():
+            self.parse_op(op_d)
+            yield self.op2HB(op_d)
+
 
 class ING_DiBa_csv_file:
-    def __init__(self, in_file):
+    encoding = 'cp1252'
+    # amounts are written 1.234,56
+    amount_columns = ('Betrag', 'Saldo')
+
+    def __init__(self, in_file, stream=False):
         self.in_file = in_file
-        self.op_d = {}
+        self.op_d = TransactionStore()
         self.headerline = None
+        self.decoder = None
 
-        self.open_csv()
+        if not stream:
+            self.open_csv()
 
     def open_csv(self):
-        logger.info('* opening {}'.format(self.in_file))
-        # remove header from csv file
-        with open(self.in_file, 'rb', encoding="cp1252") as fid:
-            fbuff = fid.read()
-
-        fbuff = fbuff[fbuff.find("Buchung"):]
-        # Replace weird chars
-#         fbuff = re.sub(u"\u007B", u"\xe9", fbuff)
-#         fbuff = re.sub(u"\u00C2\u00A0", "", fbuff)
-#         fbuff = re.sub(u"\xE4", "a", fbuff)
-#         fbuff = re.sub(u"\xDC", "U", fbuff)
-
-        # save temp csv file to process
-        fid = tempfile.NamedTemporaryFile(delete=False)
-        fid.write(fbuff.encode('utf8'))
-        fid.close()
-
-        with open(fid.name, 'rb') as csvfile:
-            csvr = csv.reader(csvfile, delimiter=';'.encode('utf8'),
-                              quotechar='"'.encode('utf8'))
-
-            for row in csvr:
-                if self.headerline is None:
-                    self.headerline = row
-                    logger.debug('=> {} elements in header.'\
-                                 .format(len(self.headerline)))
-                    # clean header
-                    for idx in range(len(self.headerline)):
-                        self.headerline[idx] = self.headerline[idx].decode('utf-8').rstrip('"')
-                        logger.info(self.headerline[idx])
-                else:
-                    self.read_op_l(row)
-        os.unlink(fid.name)
+        logger.info('* opening {}'.format(source_name(self.in_file)))
+        # with NumPy, amounts are parsed a column at a time once the file
+        # is read
+        batch = numpy is not None
+        op_l = list(self.iter_op(raw_amounts=batch))
+        if batch and self.decoder is not None:
+            # as with the row converters, absent columns are left out
+            parse_amount_columns(op_l,
+                                 self.decoder.present(self.amount_columns))
+        for sub_d in self.check_balance(op_l):
+            self.op_d.add(sub_d["Buchung"], sub_d)
         logger.debug('=> {} operations processed.'.format(len(self.op_d)))
 
-    def read_op_l(self, op_l):
-        sub_d = {}
-        for item in self.headerline:
-            if item in ["Buchung", "Valuta"]:
-                sub_d[item] = time.strptime(op_l[self.headerline.index(item)]\
-                                            .replace('"', '')\
-                                            .rstrip(' '), '%d.%m.%Y')
-                sub_d[item] = time.mktime(sub_d[item])
-            elif item in ["Betrag", "Saldo"]:
-                sub_d[item] = float(op_l[self.headerline.index(item)]\
-                                    .replace('"', '').rstrip(' ')\
-                                    .replace('.', '').replace(',', '.'))
+    def iter_lines(self):
+        ''' Yield the lines of the file starting at the "Buchung" header '''
+        with open_text(self.in_file, self.encoding) as fid:
+            # skip the account summary preceding the operations
+            for line in fid:
+                idx = line.find('Buchung')
+                if idx != -1:
+                    yield line[idx:]
+                    break
+            for line in fid:
+                yield line
+
+    def iter_op(self, raw_amounts=False):
+        ''' Yield the operations of the file one at a time, with the amounts
+        in cents (as read if raw_amounts) '''
+        self.headerline = None
+        csvr = csv.reader(metrics.timed('read', self.iter_lines()),
+                          delimiter=';', quotechar='"')
+        for row in csvr:
+            if self.headerline is None:
+                self.headerline = row
+                logger.debug('=> {} elements in header.'\
+                             .format(len(self.headerline)))
+                # clean header
+                for idx in range(len(self.headerline)):
+                    self.headerline[idx] = self.headerline[idx].rstrip('"')
+                    logger.info(self.headerline[idx])
+                self.decoder = CsvRowDecoder(self.headerline,
+                                             self.converters(raw_amounts))
             else:
-                sub_d[item] = op_l[self.headerline.index(item)].decode('utf-8').rstrip(' ')
+                metrics.count('parsed')
+                yield self.read_op_l(row)
+
+    def converters(self, raw_amounts=False):
+        ''' Converters of the columns which are not text '''
+        conv = {'Buchung': date_field('%d.%m.%Y'),
+                'Valuta': date_field('%d.%m.%Y')}
+        for name in self.amount_columns:
+            conv[name] = raw_field if raw_amounts else cents_field()
+        return conv
+
+    def check_balance(self, op_l):
+        ''' Yield the operations of op_l (in file order), checking that the
+        balance (Saldo) of each one follows from the previous one and the
+        amount (Betrag), whichever the order of the dates '''
+        prev = None
+        for op_d in op_l:
+            if prev is not None and 'Saldo' in op_d \
+                    and prev['Saldo'] - prev['Betrag'] != op_d['Saldo'] \
+                    and op_d['Saldo'] - op_d['Betrag'] != prev['Saldo']:
+                metrics.count('balance_errors')
+                logger.error('! Saldo {} on {} does not follow from {} on {}'
+                             .format(format_cents(op_d['Saldo']),
+                                     format_day(op_d['Buchung']),
+                                     format_cents(prev['Saldo']),
+                                     format_day(prev['Buchung'])))
+            prev = op_d
+            yield op_d
 
-        key = sub_d["Buchung"]
-        # make sure we have no duplicated keys in the dict
-        while key in self.op_d:
-            key += 1
-        self.op_d[key] = sub_d
+    def read_op_l(self, op_l):
+        return self.decoder(op_l)
 
-    def dic2HBdic(self):
-        out_d = {}
+    def op2HB(self, op_d):
+        ''' Convert one operation to a HomeBank record '''
         # HB fields: date, paymode, info, payee, memo, amount, category, tags
-        for item in self.op_d:
-            sub_d = {'date': time.strftime('%m/%d/%Y',
-                                   time.localtime(self.op_d[item]['Buchung'])),
-                     'paymode': PAYMODES.index("None"),
-                     'info': None,
-                     'payee': self.op_d[item]['Auftraggeber/Empfänger'],
-                     'memo': self.op_d[item]['Verwendungszweck'],
-                     'amount': self.op_d[item]['Betrag'],
-                     'category': None,
-                     'tags': None}
-
-            conv = {'Lastschrifteinzug': PAYMODES.index("Credit Card"),
-                    'Uberweisung': PAYMODES.index("Transfer"),
-                    'Gutschrift': PAYMODES.index("Transfer"),  # 5 = problem?
-                    'Gutschrift aus Dauerauftrag': PAYMODES.index("Transfer"),
-                    'Dauerauftrag/Terminueberweisung': PAYMODES.\
-                                                            index("Transfer"),
-                    }
-            if self.op_d[item]['Buchungstext'] in conv:
-                sub_d['paymode'] = conv[self.op_d[item]['Buchungstext']]
-
-            out_d[item] = sub_d
+        rec = HBRecord(op_d['Buchung'],
+                       paymode=PAYMODES.index("None"),
+                       payee=op_d['Auftraggeber/Empfänger'],
+                       memo=op_d['Verwendungszweck'],
+                       cents=op_d['Betrag'])
+
+        conv = {'Lastschrifteinzug': PAYMODES.index("Credit Card"),
+                'Uberweisung': PAYMODES.index("Transfer"),
+                'Gutschrift': PAYMODES.index("Transfer"),  # 5 = problem?
+                'Gutschrift aus Dauerauftrag': PAYMODES.index("Transfer"),
+                'Dauerauftrag/Terminueberweisung': PAYMODES.\
+                                                        index("Transfer"),
+                }
+        if op_d['Buchungstext'] in conv:
+            rec.paymode = conv[op_d['Buchungstext']]
+        return rec
+
+    def dic2HBdic(self):
+        out_d = TransactionStore()
+        for op_d in self.op_d:
+            rec = self.op2HB(op_d)
+            rec.payee = out_d.intern(rec.payee)
+            out_d.add(rec.day, rec)
         return out_d
 
+    def iter_HB(self):
+        ''' Yield HomeBank records one at a time, in file order '''
+        for op_d in self.check_balance(self.iter_op()):
+            yield self.op2HB(op_d)
+
 
 class linox_csv_file:
-    def __init__(self, in_file):
+    encoding = 'utf-16'
+    amount_columns = ('Montant',)
+
+    def __init__(self, in_file, stream=False):
         self.in_file = in_file
-        self.op_d = {}
+        self.op_d = TransactionStore()
         self.headerline = None
+        self.decoder = None
 
-        self.open_csv()
+        if not stream:
+            self.open_csv()
 
     def open_csv(self):
-        logger.info('* opening {}'.format(self.in_file))
-        with open(self.in_file, 'rb', encoding='utf-16') as f:
-            for row in csv.reader(f, delimiter='\t'.encode('ascii')):
+        logger.info('* opening {}'.format(source_name(self.in_file)))
+        # with NumPy, amounts are parsed a column at a time once the file
+        # is read
+        batch = numpy is not None
+        op_l = list(self.iter_op(raw_amounts=batch))
+        if batch and self.decoder is not None:
+            # as with the row converters, absent columns are left out
+            parse_amount_columns(op_l,
+                                 self.decoder.present(self.amount_columns))
+        for sub_d in op_l:
+            self.op_d.add(sub_d["Date"], sub_d)
+        logger.info('=> {} operations processed.'.format(len(self.op_d)))
+
+    def iter_op(self, raw_amounts=False):
+        ''' Yield the operations of the file one at a time, with the amounts
+        in cents (as read if raw_amounts) '''
+        self.headerline = None
+        with open_text(self.in_file, self.encoding) as f:
+            for row in csv.reader(metrics.timed('read', f), delimiter='\t'):
                 if self.headerline == None:
                     self.headerline = row
                     logger.debug('=> {} elements in header.'\
                                  .format(len(self.headerline)))
+                    self.decoder = CsvRowDecoder(self.headerline,
+                                                 self.converters(raw_amounts))
                 else:
                     if len(row) == len(self.headerline):
-                        self.read_op_l(row)
+                        metrics.count('parsed')
+                        yield self.read_op_l(row)
                     else:
+                        metrics.count('empty')
                         logger.error('! Empty record?')
                         logger.error('! {}'.format(row))
 
-        logger.info('=> {} operations processed.'.format(len(self.op_d)))
+    def converters(self, raw_amounts=False):
+        ''' Converters of the columns which are not text '''
+        conv = {'Date': date_field('%d/%m/%Y')}
+        for name in self.amount_columns:
+            conv[name] = raw_field if raw_amounts else cents_field()
+        return conv
 
     def read_op_l(self, op_l):
-        sub_d = {}
-        for item in self.headerline:
-            if item == "Date":
-                sub_d[item] = time.strptime(op_l[self.headerline.index(item)],
-                                            '%d/%m/%Y')
-                sub_d[item] = time.mktime(sub_d[item])
-            elif item == "Montant":
-                sub_d[item] = float(op_l[self.headerline.index(item)]\
-                                    .replace('"', '').rstrip(' ')\
-                                    .replace('.', '').replace(',', '.'))
-            else:
-                sub_d[item] = op_l[self.headerline.index(item)].rstrip(' ')
+        return self.decoder(op_l)
 
-        key = sub_d["Date"]
-        # make sure we have no duplicated keys in the dict
-        while key in self.op_d:
-            key += 1
-        self.op_d[key] = sub_d
+    def op2HB(self, op_d):
+        ''' Convert one operation to a HomeBank record '''
+        # HB fields: date, paymode, info, payee, memo, amount, category, tags
+        # the label is the second column ('Libell\xe9')
+        rec = HBRecord(op_d['Date'],
+                       paymode=PAYMODES.index("None"),
+                       payee=op_d[self.headerline[1]],
+                       memo=op_d[self.headerline[1]],
+                       cents=op_d['Montant'])
+
+#         conv = {'Lastschrifteinzug': PAYMODES.index("Credit Card"),
+#                 'Uberweisung': PAYMODES.index("Transfer"),
+#                 'Gutschrift': PAYMODES.index("Internal Transfer"),
+#                 'Gutschrift aus Dauerauftrag': PAYMODES.index("Transfer"),
+#                 'Dauerauftrag/Terminueberweisung': PAYMODES.\
+#                                                         index("Transfer"),
+#                 }
+#         if op_d['Buchungstext'] in conv:
+#             rec.paymode = conv[op_d['Buchungstext']]
+        return rec
 
     def dic2HBdic(self):
-        out_d = {}
-        # HB fields: date, paymode, info, payee, memo, amount, category, tags
-        # unicode issues with labels, taking them from self.headline
-        # ['Date', 'Libell\xc3\xa9', 'Cat\xc3\xa9gorie', 'Montant', 'Notes', 'N\xc2\xb0 de ch\xc3\xa8que', 'Labels']
-        for item in self.op_d:
-#             dispdic(self.op_d[item])
-            sub_d = {'date': time.strftime('%m/%d/%Y',
-                                   time.gmtime(self.op_d[item]['Date'])),
-                     'paymode': PAYMODES.index("None"),
-                     'info': None,
-                     'payee': self.op_d[item][self.headerline[1]],
-                     'memo': self.op_d[item][self.headerline[1]],
-                     'amount': self.op_d[item]['Montant'],
-                     'category': None,
-                     'tags': None}
-
-#             conv = {'Lastschrifteinzug': PAYMODES.index("Credit Card"),
-#                     'Uberweisung': PAYMODES.index("Transfer"),
-#                     'Gutschrift': PAYMODES.index("Internal Transfer"),
-#                     'Gutschrift aus Dauerauftrag': PAYMODES.index("Transfer"),
-#                     'Dauerauftrag/Terminueberweisung': PAYMODES.\
-#                                                             index("Transfer"),
-#                     }
-#             if self.op_d[item]['Buchungstext'] in conv:
-#                 sub_d['paymode'] = conv[self.op_d[item]['Buchungstext']]
-
-            out_d[item] = sub_d
+        out_d = TransactionStore()
+        for op_d in self.op_d:
+            rec = self.op2HB(op_d)
+            rec.payee = out_d.intern(rec.payee)
+            out_d.add(rec.day, rec)
         return out_d
 
+    def iter_HB(self):
+        ''' Yield HomeBank records one at a time, in file order '''
+        for op_d in self.iter_op():
+            yield self.op2HB(op_d)
+
+
+def open_output(out_file):
+    ''' QIF or CSV output file: UTF-8 text with '\n' line ends, written to a
+    temporary file which replaces out_file when closed by close_outputs.
+    Text streams are returned as they are. '''
+    if not is_path(out_file):
+        return out_file
+    return open(out_file + '.tmp', 'w', encoding='utf8', newline='')
+
+
+def close_outputs(fid_d, done=True):
+    ''' Close the outputs (out_file -> fid) opened by open_output. If done,
+    the files written replace the outputs, otherwise they are removed and
+    the outputs are left as they were. '''
+    for out_file, fid in fid_d.items():
+        if not is_path(out_file):
+            continue
+        fid.close()
+        if done:
+            os.replace(out_file + '.tmp', out_file)
+        elif isfile(out_file + '.tmp'):
+            os.remove(out_file + '.tmp')
+
 
 class HomeBankDataWriter:
+    # records rendered in memory between two writes
+    chunk_size = 1000
+
     def __init__(self, in_dic, head=None):
-        ''' Import dict containing data '''
+        ''' Import TransactionStore of HBRecord containing data '''
         logger.debug('* Import data dic with {} records.'.format(len(in_dic)))
         self.op_d = in_dic
         self.headerline = head
 
     def export_qif(self, out_file):
         ''' Export to a QIF format handled by Homebank '''
+        return self.write(self.op_d, out_file_qif=out_file)
+
+    def export_csv(self, out_file):
+        return self.write(self.op_d, out_file_csv=out_file)
+
+    def export(self, out_file_qif, out_file_csv):
+        ''' Export to QIF and CSV in a single pass '''
+        return self.write(self.op_d, out_file_qif, out_file_csv)
+
+    def render_qif(self, rec):
+        ''' QIF operation, with its category (L line) if it has one '''
+        if rec.category:
+            return 'D{}\nT{}\nP{}\nM{}\nL{}\n^\n'.format(
+                rec.date, rec.amount, rec.payee, rec.memo, rec.category)
+        return 'D{}\nT{}\nP{}\nM{}\n^\n'.format(rec.date, rec.amount,
+                                                rec.payee, rec.memo)
+
+    def render_csv(self, rec):
+        ''' CSV line of an operation '''
+        return '{};{};{};{};{};{};{};{}\n'.format(
+            rec.date, '' if rec.paymode is None else rec.paymode,
+            rec.info or '', rec.payee or '', rec.memo or '', rec.amount,
+            rec.category or '', rec.tags or '')
+
+    def write(self, records, out_file_qif=None, out_file_csv=None):
+        ''' Write records to the QIF and/or CSV file (UTF-8) in one pass.
+        The files can also be text streams, which are left open.
+        Records are rendered by chunks of chunk_size, written at once.
+        The files are only replaced once both are written: returns the
+        number of records, None if they could not be written. '''
         cnt = 0
-        if self.headerline == None:
+        if out_file_qif is not None and self.headerline == None:
             logger.warning('! No QIF header defined, using default.')
             self.headerline = '!Type:Bank\n'
-        with open(out_file, 'wb') as fid:
-            fid.write(self.headerline)
-            for key in sorted(self.op_d.keys()):
-                self.write_op(fid, self.op_d[key])
-                fid.write('^\n')
+        fid_qif = None
+        fid_csv = None
+        fid_d = OrderedDict()
+        done = False
+        try:
+            if out_file_qif is not None:
+                fid_qif = fid_d[out_file_qif] = open_output(out_file_qif)
+            if out_file_csv is not None:
+                fid_csv = fid_d[out_file_csv] = open_output(out_file_csv)
+            if fid_qif is not None:
+                fid_qif.write(self.headerline)
+            if fid_csv is not None:
+                fid_csv.write(';'.join(CSV_HEAD) + '\n')
+
+            debug = logger.isEnabledFor(logging.DEBUG)
+            qif_l = []
+            csv_l = []
+            for rec in records:
+                if fid_qif is not None:
+                    qif_l.append(self.render_qif(rec))
+                if fid_csv is not None:
+                    csv_l.append(self.render_csv(rec))
+                    if debug:
+                        logger.debug(csv_l[-1].rstrip('\n'))
                 cnt += 1
-        logger.info('=> Exported {} entries to {}.'.format(cnt, out_file))
+                if cnt % self.chunk_size == 0:
+                    self.flush(fid_qif, qif_l)
+                    self.flush(fid_csv, csv_l)
+            self.flush(fid_qif, qif_l)
+            self.flush(fid_csv, csv_l)
+            close_outputs(fid_d)
+            done = True
+        except IOError:
+            logger.error('! Cannot write the file,'
+                         ' could it be opened in Excel ?')
+            logger.error('! {}'.format(' / '.join(
+                source_name(out_file) for out_file
+                in [out_file_qif, out_file_csv] if out_file is not None)))
+        finally:
+            if not done:
+                close_outputs(fid_d, done=False)
+        if not done:
+            return None
+        for out_file in [out_file_qif, out_file_csv]:
+            if out_file is not None:
+                logger.info('=> Exported {} entries to {}.'.format(
+                    cnt, source_name(out_file)))
+        return cnt
+
+    def flush(self, fid, chunk_l):
+        if fid is not None and len(chunk_l) > 0:
+            fid.write(''.join(chunk_l))
+        del chunk_l[:]
+
+
+def _spill_chunk(chunk):
+    ''' Save a sorted chunk to a temporary file, one JSON entry per line '''
+    fid = tempfile.TemporaryFile('w+', encoding='utf8')
+    for entry in chunk:
+        day, seq, rec = entry
+        fid.write(json.dumps([day, seq, rec.to_list()]))
+        fid.write('\n')
+    fid.seek(0)
+    return fid
+
+
+def _read_chunk(fid):
+    for line in fid:
+        day, seq, rec_l = json.loads(line)
+        yield day, seq, HBRecord(*rec_l)
+
+
+def sort_HB_stream(records, chunk_size=50000):
+    ''' Sort HomeBank records by date with bounded memory.
+    Chunks of chunk_size records are sorted and written to temporary files,
+    which are then merged lazily. Records of the same day keep their order. '''
+    chunk = []
+    spill_l = []
+    try:
+        for seq, rec in enumerate(records):
+            chunk.append((rec.day, seq, rec))
+            if len(chunk) >= chunk_size:
+                chunk.sort()
+                spill_l.append(_spill_chunk(chunk))
+                chunk = []
+        chunk.sort()
+        if len(spill_l) > 0:
+            logger.debug('=> Merging {} sorted chunks.'.format(len(spill_l)
+                                                              + 1))
+        for entry in heapq.merge(iter(chunk),
+                                 *[_read_chunk(fid) for fid in spill_l]):
+            yield entry[2]
+    finally:
+        for fid in spill_l:
+            fid.close()
+
+
+class HomeBankStreamWriter(HomeBankDataWriter):
+    ''' Writes HomeBank records as they are produced by the parsers,
+    QIF and CSV in the same pass, without holding all records in memory '''
+    def __init__(self, head=None, sort=True, sort_chunk_size=50000):
+        self.op_d = None
+        self.headerline = head
+        self.sort = sort
+        self.sort_chunk_size = sort_chunk_size
 
-    def write_op(self, fid, op_d):
-        ''' Write QIF operation '''
-        fid.write('D{}\n'.format(op_d['date']).encode('utf8'))
-        fid.write('T{}\n'.format(op_d['amount']).encode('utf8'))
-        fid.write('P{}\n'.format(op_d['payee']).encode('utf8'))
-        fid.write('M{}\n'.format(op_d['memo']).encode('utf8'))
+    def export(self, records, out_file_qif, out_file_csv):
+        if self.sort:
+            records = sort_HB_stream(records, self.sort_chunk_size)
+        return self.write(records, out_file_qif, out_file_csv)
 
-    def export_csv(self, out_file):
-        cnt = 0
+
+def _tag_records(records, idx):
+    ''' Sort keys of the records of the source idx, for heapq.merge '''
+    for seq, rec in enumerate(records):
+        yield rec.day, idx, seq, rec
+
+
+class ConsolidatedWriter(HomeBankDataWriter):
+    ''' Merges the records of several files by date into one QIF per account
+    and one CSV for all accounts. The records of each file must be sorted by
+    date; they are merged lazily, without holding them all in memory. '''
+    def __init__(self):
+        self.op_d = None
+        self.headerline = None
+        self.sources = []
+
+    def add(self, account, records, head=None):
+        ''' Add the records (sorted by date) of one file of account '''
+        self.sources.append((account, head, records))
+
+    def export(self, out_dir, csv_name=CONSOLIDATED_CSV):
+        ''' Write out_dir/<account>.qif and out_dir/csv_name, which are only
+        replaced once all are written. Returns the number of records
+        exported for each account, None if the files could not be
+        written. '''
+        heads = OrderedDict()
+        for account, head, records in self.sources:
+            if heads.get(account) is None:
+                heads[account] = head
+        accounts = [account for account, head, records in self.sources]
+        merged = heapq.merge(*[_tag_records(records, idx) for idx, records
+                               in enumerate(src[2] for src in self.sources)])
+
+        out_file_csv = join(out_dir, csv_name)
+        out_files = dict((account, join(out_dir, account + '.qif'))
+                         for account in heads)
+        cnt = Counter()
+        fid_d = {}
+        out_d = OrderedDict()  # out_file -> fid, for close_outputs
+        done = False
         try:
-            with open(out_file, 'wb') as fid:
-                head_l = ['date', 'paymode', 'info', 'payee', 'wording',
-                          'amount', 'category', 'tags']
-
-                dic_l = ['date', 'paymode', 'info', 'payee', 'memo',
-                         'amount', 'category', 'tags']
-
-                # .encode("codec") should be applied to str before writing
-                # need to determing code expected by homebank
-                fid.write(';'.join(head_l))
-                fid.write('\n')
-
-                for key in sorted(self.op_d.keys()):
-                    l = []
-                    for item in dic_l:
-                        t = self.op_d[key][item]
-                        if self.op_d[key][item] == None:
-                            l.append('')
-                        elif (isinstance(t, int) or isinstance(t, float)):
-                            l.append(str(self.op_d[key][item]))
-                        elif isinstance(t, unicode):
-                            l.append(self.op_d[key][item])
-                        elif isinstance(t, str):
-                            l.append(self.op_d[key][item].decode('utf-8'))
-                        else:
-                            logger.error('!!! Type of element appended not defined => will cause trouble')
-                            logger.error('!!! Type: {} ({})'.format(type(t), t))
-                            l.append(self.op_d[key][item])
-                    logger.info(l)
-                    try:
-                        fid.write(';'.join(l))
-                        fid.write('\n')
-                        cnt += 1
-                    except BaseException, e:
-                        logger.error('!!! {} - {}'.format(e, l))
+            for account in heads:
+                fid_d[account] = out_d[out_files[account]] = \
+                    open_output(out_files[account])
+            fid_csv = out_d[out_file_csv] = open_output(out_file_csv)
+            for account, head in heads.items():
+                fid_d[account].write(head or '!Type:Bank\n')
+            fid_csv.write(';'.join(CSV_HEAD) + '\n')
+
+            qif_d = dict((account, []) for account in heads)
+            csv_l = []
+            for day, idx, seq, rec in merged:
+                qif_d[accounts[idx]].append(self.render_qif(rec))
+                csv_l.append(self.render_csv(rec))
+                cnt[accounts[idx]] += 1
+                if len(csv_l) >= self.chunk_size:
+                    for account in heads:
+                        self.flush(fid_d[account], qif_d[account])
+                    self.flush(fid_csv, csv_l)
+            for account in heads:
+                self.flush(fid_d[account], qif_d[account])
+            self.flush(fid_csv, csv_l)
+            close_outputs(out_d)
+            done = True
         except IOError:
-            logger.error('! Cannot open the file,'
+            logger.error('! Cannot write the file,'
                          ' could it be opened in Excel ?')
-            logger.error('! {}'.format(out_file))
-        logger.info('=> Exported {} entries to {}.'.format(cnt, out_file))
+            logger.error('! {}'.format(' / '.join(
+                list(out_files.values()) + [out_file_csv])))
+        finally:
+            if not done:
+                close_outputs(out_d, done=False)
+        if not done:
+            return None
+        for account in heads:
+            logger.info('=> Exported {} entries to {}.'.format(
+                cnt[account], out_files[account]))
+        logger.info('=> Exported {} entries to {}.'.format(
+            sum(cnt.values()), out_file_csv))
+        return cnt
 
 
 def getTypeFromFileName(in_file):
-    for typ in filetypes:
-        if re.match(filetypes[typ], in_file):
-            return typ
-    return None
-
-
-def main_no_args():
+    fmt, m = formats.match(in_file)
+    return None if fmt is None else fmt.name
+
+
+def getTypeFromContent(in_file, size=SNIFF_SIZE):
+    ''' Type of in_file found from its first size bytes, None if unknown '''
+    fmt = formats.sniff(read_head(in_file, size))
+    return None if fmt is None else fmt.name
+
+
+def detect_type(in_file, name=None):
+    ''' Type of in_file, from its name or else, if its name matches no
+    format, from its content. name is the file name of bytes and file
+    objects, if known. '''
+    if name is None and is_path(in_file):
+        name = in_file
+    typ = None
+    if name is not None:
+        typ = getTypeFromFileName(os.path.basename(name))
+    # formats registered without a parser are not converted on purpose
+    if typ is None and (not is_path(in_file) or isfile(in_file)):
+        sniffed = getTypeFromContent(in_file)
+        if sniffed is not None:
+            logger.info('* Type {} found from the content of {}'.format(
+                sniffed, source_name(in_file) if name is None else name))
+            typ = sniffed
+    return typ
+
+
+def getAccountFromFileName(in_file, typ=None):
+    ''' Account number found in the file name, the file type otherwise '''
+    fmt, m = formats.match(os.path.basename(in_file))
+    if typ is None and fmt is not None:
+        typ = fmt.name
+    if fmt is not None and fmt.name == typ:
+        account = m.groupdict().get('{}_account'.format(m.lastgroup))
+        if account is not None:
+            return account
+    return typ
+
+
+def normalize_payee(payee):
+    ''' Payee reduced to upper case words, for comparisons '''
+    return ' '.join(re.findall(r'\w+', payee or '', re.UNICODE)).upper()
+
+
+class DuplicateIndex:
+    ''' Persistent index of the fingerprints (account, date, amount, payee)
+    of the exported operations, used to drop operations already exported
+    from another file (overlapping bank exports). The fingerprints of a
+    file enter the index when its conversion is committed. '''
+    def __init__(self, path):
+        self.path = path
+        self.seen = {}  # fingerprint -> file it was exported from
+        self.new = []
+        self.dropped = []
+        # same, for the files whose conversion is not committed yet
+        self.pending = {}
+        self.pending_dropped = {}
+        if isfile(self.path):
+            with open(self.path, encoding='utf8') as fid:
+                for line in fid:
+                    fp, in_file = line.rstrip('\n').split('\t', 1)
+                    self.seen[fp] = in_file
+        logger.debug('* {} operations in duplicate index.'\
+                     .format(len(self.seen)))
+
+    def fingerprint(self, account, rec, occurrence):
+        key = '\t'.join([account, str(rec.day), str(rec.cents),
+                         normalize_payee(rec.payee), str(occurrence)])
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def __call__(self, records, in_file, typ=None):
+        ''' Yield the records of in_file not exported from another file.
+        The account is found in the file name, it is the type of the file
+        if there is none (e.g. renamed files). '''
+        account = getAccountFromFileName(in_file, typ)
+        # identical operations of the same file are counted, so that two
+        # real identical payments are not taken for duplicates
+        occurrence_d = {}
+        for rec in records:
+            key = (rec.day, rec.cents, normalize_payee(rec.payee))
+            occurrence = occurrence_d.get(key, 0)
+            occurrence_d[key] = occurrence + 1
+            fp = self.fingerprint(account, rec, occurrence)
+            source = self.seen.get(fp, self.pending.get(fp))
+            if source is None:
+                self.pending[fp] = in_file
+            elif source != in_file:
+                metrics.count('duplicates')
+                self.pending_dropped.setdefault(in_file, []).append(
+                    (in_file, source, rec))
+                continue
+            yield rec
+
+    def commit(self, in_file, done=True):
+        ''' Add the fingerprints of in_file to the index if its conversion
+        succeeded (done), forget them otherwise '''
+        for fp in [fp for fp, f in self.pending.items() if f == in_file]:
+            del self.pending[fp]
+            if done:
+                self.seen[fp] = in_file
+                self.new.append((fp, in_file))
+        dropped_l = self.pending_dropped.pop(in_file, [])
+        if done:
+            self.dropped.extend(dropped_l)
+
+    def save(self):
+        with open(self.path, 'a', encoding='utf8') as fid:
+            for fp, in_file in self.new:
+                fid.write('{}\t{}\n'.format(fp, in_file))
+        self.new = []
+
+    def report(self):
+        ''' Log the dropped duplicates '''
+        if len(self.dropped) == 0:
+            return
+        logger.info('')
+        logger.info('=> {} duplicated operations dropped:'\
+                    .format(len(self.dropped)))
+        for in_file, source, rec in self.dropped:
+            logger.info('  {} {} {:>10} {} (already in {})'.format(
+                in_file, rec.date, rec.amount, rec.payee, source))
+
+
+def parse_xhb_amount(s):
+    ''' Cents of an amount of a HomeBank file, written as a float
+    (e.g. "-12.340000000000002") '''
+    try:
+        return parse_cents(s)
+    except ValueError:
+        # exponent notation
+        return int(round(float(s) * 100))
+
+
+class HomeBankLedger:
+    ''' Index of the operations of a HomeBank file (.xhb) by date, amount
+    and payee, used to drop the operations already imported in HomeBank.
+    The file is parsed as a stream, only the index is kept in memory.
+    Operations are compared whichever their account. '''
+    def __init__(self, path):
+        self.path = path
+        self.hash = file_hash(path)
+        # (day, cents, normalized payee) -> number of operations
+        self.index = Counter()
+        pay_d = {}
+        ope_c = Counter()  # operations by payee key
+        root = None
+        for event, elem in ElementTree.iterparse(path, ('start', 'end')):
+            if root is None:
+                root = elem
+            elif event == 'end':
+                if elem.tag == 'pay':
+                    pay_d[elem.get('key')] = normalize_payee(elem.get('name'))
+                elif elem.tag == 'ope':
+                    # dates are GLib julian days: 1 is 01/01/0001, as
+                    # Python ordinals
+                    ope_c[(int(elem.get('date')),
+                           parse_xhb_amount(elem.get('amount', '0')),
+                           elem.get('payee'))] += 1
+                # the elements read are dropped
+                root.clear()
+        # the payees may be listed after the operations
+        for (day, cents, key), cnt in ope_c.items():
+            self.index[(day, cents, pay_d.get(key, ''))] += cnt
+        logger.info('* {} operations in {}'.format(sum(ope_c.values()),
+                                                   path))
+
+    def fingerprint(self):
+        return ['xhb', self.hash]
+
+    def __call__(self, records, in_file, typ=None):
+        ''' Yield the records of in_file which are not in the HomeBank file.
+        n identical operations of the HomeBank file drop the first n
+        identical records of in_file. '''
+        occurrence_d = Counter()
+        dropped = 0
+        for rec in records:
+            key = (rec.day, rec.cents, normalize_payee(rec.payee))
+            occurrence_d[key] += 1
+            if occurrence_d[key] <= self.index.get(key, 0):
+                metrics.count('already_imported')
+                dropped += 1
+                logger.debug('  {} {:>10} {} already imported'.format(
+                    rec.date, rec.amount, rec.payee))
+                continue
+            yield rec
+        if dropped > 0:
+            logger.info('=> {} operations of {} already in {}, dropped.'\
+                        .format(dropped, in_file, self.path))
+
+
+class Categorizer:
+    ''' Sets the category and tags of the records without any, from rules
+    on the payee or memo and from the categories of a HomeBank history.
+    rules: list of {"type": "exact", "prefix" or "regex",
+                    "pattern": ..., "field": "payee" (default) or "memo",
+                    "category": ..., "tags": ...}
+    Exact and prefix rules compare normalized strings (see normalize_payee)
+    through a dict and a trie, the result of each payee is memoized. '''
+    def __init__(self, rules=(), history=None, cache_size=10000):
+        self.rules = list(rules)
+        self.exact_d = {'payee': {}, 'memo': {}}
+        self.trie_d = {'payee': {}, 'memo': {}}
+        self.regex_l = []
+        self.learned_d = {}
+        self.history_hash = None
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+        for rule in self.rules:
+            field = rule.get('field', 'payee')
+            value = (rule.get('category'), rule.get('tags'))
+            if rule['type'] == 'exact':
+                key = normalize_payee(rule['pattern'])
+                self.exact_d[field].setdefault(key, value)
+            elif rule['type'] == 'prefix':
+                node = self.trie_d[field]
+                for char in normalize_payee(rule['pattern']):
+                    node = node.setdefault(char, {})
+                node.setdefault('', value)
+            elif rule['type'] == 'regex':
+                self.regex_l.append((field,
+                                     re.compile(rule['pattern'], re.UNICODE),
+                                     value))
+            else:
+                raise ValueError('Unknown rule type {}'.format(rule['type']))
+        # the memo can only be left out of the cache key if no rule uses it
+        self.use_memo = any(rule.get('field') == 'memo'
+                            for rule in self.rules)
+        if history is not None:
+            self.learn(history)
+
+    def learn(self, history):
+        ''' Learn the most frequent category and tags of each payee from a
+        CSV file exported by HomeBank (or by this script) '''
+        count_d = {}
+        with open(history, encoding='utf8', newline='') as fid:
+            csvr = csv.reader(fid, delimiter=';')
+            head_l = next(csvr)
+            idx_payee = head_l.index('payee')
+            idx_category = head_l.index('category')
+            idx_tags = head_l.index('tags') if 'tags' in head_l else None
+            for row in csvr:
+                if len(row) <= idx_category or row[idx_category] == '':
+                    continue
+                payee = normalize_payee(row[idx_payee])
+                tags = None
+                if idx_tags is not None and len(row) > idx_tags:
+                    tags = row[idx_tags] or None
+                count_d.setdefault(payee, Counter())\
+                       [(row[idx_category], tags)] += 1
+        for payee, counter in count_d.items():
+            self.learned_d[payee] = counter.most_common(1)[0][0]
+        self.history_hash = file_hash(history)
+        self.cache.clear()
+        logger.info('* {} payees learned from {}'.format(len(count_d),
+                                                         history))
+
+    def fingerprint(self):
+        return [self.rules, self.history_hash]
+
+    def lookup_trie(self, field, text):
+        ''' Value of the longest prefix rule matching text '''
+        node = self.trie_d[field]
+        value = node.get('')
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            value = node.get('', value)
+        return value
+
+    def categorize(self, payee, memo):
+        ''' (category, tags) of an operation, (None, None) if unknown '''
+        key = (payee, memo) if self.use_memo else payee
+        value = self.cache.get(key)
+        if value is not None:
+            # most recently used entries are kept at the end
+            del self.cache[key]
+            self.cache[key] = value
+            return value
+
+        text_d = {'payee': normalize_payee(payee),
+                  'memo': normalize_payee(memo)}
+        value = None
+        for field in ('payee', 'memo'):
+            value = self.exact_d[field].get(text_d[field])
+            if value is None:
+                value = self.lookup_trie(field, text_d[field])
+            if value is not None:
+                break
+        if value is None:
+            for field, regex, rule_value in self.regex_l:
+                if regex.search((payee if field == 'payee' else memo) or ''):
+                    value = rule_value
+                    break
+        if value is None:
+            value = self.learned_d.get(text_d['payee'], (None, None))
+
+        self.cache[key] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+    def __call__(self, records, in_file, typ=None):
+        for rec in records:
+            if rec.category is None:
+                category, tags = self.categorize(rec.payee, rec.memo)
+                rec.category = category
+                if rec.tags is None:
+                    rec.tags = tags
+            yield rec
+
+
+def stage_name(stage):
+    ''' Name of the timer of a stage (function or callable instance) '''
+    return 'stage:' + getattr(stage, '__name__', stage.__class__.__name__)
+
+
+def open_file(typ, in_file, stream=False, rules=None):
+    ''' Parser of in_file for its type and the header of the QIF file
+    (None if the parser does not provide it). rules replaces the rule
+    engine of the parsers having one (rules class attribute). '''
+    fmt = formats[typ]
+    if not fmt.complete:
+        logger.warning('! Implementation not complete')
+    parser = fmt.get_parser()
+    kwargs = {}
+    if rules is not None and hasattr(parser, 'rules'):
+        kwargs['rules'] = rules
+    metrics.start('parse')
+    data_d = parser(in_file, stream=stream, **kwargs)
+    metrics.stop()
+    return data_d, data_d.headerline if fmt.qif_head else None
+
+
+def read_records(typ, in_file, stream=False, stages=(), name=None,
+                 rules=None):
+    ''' HomeBank records of in_file of type typ and the QIF header.
+    With stream, the records are yielded one at a time in file order,
+    otherwise they are returned in a TransactionStore (sorted by date).
+    stages are applied in order to the records, as stage(records, name,
+    typ) (name defaults to in_file), and return the records to keep.
+    rules: see open_file. '''
+    if name is None:
+        name = in_file
+    data_d, head = open_file(typ, in_file, stream, rules)
+    if stream:
+        records = metrics.timed('parse', data_d.iter_HB())
+        for stage in stages:
+            records = metrics.timed(stage_name(stage),
+                                    stage(records, name, typ))
+        return records, head
+    metrics.start('convert')
+    store = data_d.dic2HBdic()
+    metrics.stop()
+    if len(stages) > 0:
+        records = iter(store)
+        for stage in stages:
+            records = metrics.timed(stage_name(stage),
+                                    stage(records, name, typ))
+        store = TransactionStore()
+        for rec in records:
+            store.add(rec.day, rec)
+    return store, head
+
+
+def convert_file(typ, in_file, out_file_qif, out_file_csv, stream=False,
+                 stages=(), name=None, rules=None):
+    ''' Convert in_file of type typ to HomeBank QIF and CSV files.
+    With stream, records go from the parser to the files one at a time.
+    stages, name and rules: see read_records.
+    Returns the number of exported records, None if the type is unknown or
+    the files could not be written. '''
+    if not formats.can_convert(typ):
+        logger.error('! Type not determined for {}'.format(in_file))
+        logger.error('! Skipping.')
+        return None
+    records, head = read_records(typ, in_file, stream, stages, name, rules)
+    if stream:
+        HB = HomeBankStreamWriter(head)
+        metrics.start('export')
+        cnt = HB.export(records, out_file_qif, out_file_csv)
+    else:
+        HB = HomeBankDataWriter(records, head)
+        metrics.start('export')
+        cnt = HB.export(out_file_qif, out_file_csv)
+    metrics.stop()
+    if cnt is not None:
+        metrics.count('exported', cnt)
+    return cnt
+
+
+def consolidate_files(file_l, out_dir, stages=()):
+    ''' Convert the files, as (type, path), to one QIF per account (from the
+    file names) and one CSV in out_dir. Each file is read as a stream and
+    sorted by date before the merge. Returns the number of exported
+    records, None if the files could not be written. '''
+    HB = ConsolidatedWriter()
+    for typ, in_file in file_l:
+        logger.info('* opening {}'.format(in_file))
+        records, head = read_records(typ, in_file, True, stages)
+        HB.add(getAccountFromFileName(in_file, typ),
+               metrics.timed('sort', sort_HB_stream(records)), head)
+    metrics.start('export')
+    cnt_d = HB.export(out_dir)
+    metrics.stop()
+    if cnt_d is None:
+        return None
+    cnt = sum(cnt_d.values())
+    metrics.count('exported', cnt)
+    return cnt
+
+
+class ConversionSession:
+    ''' Converts files one after the other in the same process, for the
+    applications using this script as a module. The rules, categorizer and
+    duplicate index are loaded once and kept, with the date and category
+    caches, for all the conversions of the session.
+    Inputs are file names, bytes or binary file objects; outputs are file
+    names or text streams. Failed conversions raise an exception. Logging is
+    left to the application (messages go to the "conv2homebank" logger).
+    The timers and counters of all its conversions add up in its metrics.
+
+        with ConversionSession(categories=load_rules('categories.json'),
+                               dedup_index='index') as session:
+            for name, data in statements:
+                cnt = session.convert(data, out_file_csv=buff, name=name)
+    '''
+    def __init__(self, rules=None, categories=None, history=None,
+                 dedup_index=None, stream=False, xhb=None):
+        ''' rules: Boursorama rules tried before BOURSORAMA_RULES
+        categories, history: category rules and HomeBank CSV of a Categorizer
+        dedup_index: file of a DuplicateIndex, saved by close()
+        stream: convert the records one at a time (constant memory)
+        xhb: HomeBank file whose operations are dropped (HomeBankLedger) '''
+        self.stream = stream
+        self.rules = None
+        if rules is not None:
+            self.rules = RuleEngine(list(rules) + BOURSORAMA_RULES)
+        self.stages = []
+        self.ledger = None
+        if xhb is not None:
+            self.ledger = HomeBankLedger(xhb)
+            self.stages.append(self.ledger)
+        self.dedup = None
+        if dedup_index is not None:
+            self.dedup = DuplicateIndex(dedup_index)
+            self.stages.append(self.dedup)
+        self.categorizer = None
+        if categories is not None or history is not None:
+            self.categorizer = Categorizer(categories or (), history)
+            self.stages.append(self.categorizer)
+        self.metrics = Metrics()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        ''' Save the duplicate index '''
+        if self.dedup is not None:
+            self.dedup.save()
+
+    def prepare(self, source, typ=None, name=None):
+        ''' (source, type, name) of an input. name is the file name of
+        bytes and file objects, from which the type (unless given) and the
+        account are found; otherwise the type is found from the content and
+        the account is the type. '''
+        if name is None:
+            if self.dedup is not None and not is_path(source) \
+                    and not hasattr(source, 'name'):
+                # the duplicate index tells the inputs apart by their name
+                source, name = self.content_name(source)
+            else:
+                name = source_name(source)
+        if typ is None:
+            if not is_path(source) and not isinstance(source, (bytes,
+                                                               bytearray)) \
+                    and not source.seekable():
+                # the start of the file is read to find its type
+                source = source.read()
+            typ = detect_type(source, name)
+        if not formats.can_convert(typ):
+            raise ValueError('Type not determined for {}'.format(name))
+        return source, typ, name
+
+    def content_name(self, source):
+        ''' (source, name) of bytes or a file object without a name, the name
+        being the hash of its content; file objects which cannot seek are
+        read '''
+        h = hashlib.sha1()
+        if isinstance(source, (bytes, bytearray)):
+            h.update(source)
+        elif source.seekable():
+            pos = source.tell()
+            for buff in iter(lambda: source.read(1 << 16), b''):
+                h.update(buff)
+            source.seek(pos)
+        else:
+            source = source.read()
+            h.update(source)
+        return source, '<{}>'.format(h.hexdigest())
+
+    def run(self, name, func, *args):
+        ''' func(*args), its timers and counters being added to the metrics
+        of the session. The operations of name enter the duplicate index if
+        it returns a result. '''
+        depth = len(metrics.stack)
+        timers = metrics.timers.copy()
+        counters = metrics.counters.copy()
+        res = None
+        try:
+            res = func(*args)
+            return res
+        finally:
+            # phases interrupted by an error
+            while len(metrics.stack) > depth:
+                metrics.stop()
+            self.metrics.timers.update(metrics.timers - timers)
+            self.metrics.counters.update(metrics.counters - counters)
+            if self.dedup is not None:
+                self.dedup.commit(name, res is not None)
+
+    def records(self, source, typ=None, name=None):
+        ''' List of the HomeBank records (HBRecord) of source, sorted by
+        date '''
+        source, typ, name = self.prepare(source, typ, name)
+        store, head = self.run(name, read_records, typ, source, False,
+                               self.stages, name, self.rules)
+        return list(store)
+
+    def convert(self, source, out_file_qif=None, out_file_csv=None,
+                typ=None, name=None):
+        ''' Convert source to a QIF and/or a CSV file (file names or text
+        streams). Returns the number of records written. '''
+        source, typ, name = self.prepare(source, typ, name)
+        cnt = self.run(name, convert_file, typ, source, out_file_qif,
+                       out_file_csv, self.stream, self.stages, name,
+                       self.rules)
+        if cnt is None:
+            raise IOError('Cannot write the conversion of {}'.format(name))
+        return cnt
+
+
+class ErrorCounter(logging.Handler):
+    ''' Counts the errors logged while it is attached '''
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def init_worker(rules, format_l):
+    ''' Install the Boursorama rules and the formats of the main process in
+    a worker of --jobs: workers started by spawn (Windows, macOS) import the
+    script again and would use the default ones '''
+    boursorama_qif_file.rules = rules
+    for fmt in format_l:
+        formats.register(fmt)
+
+
+def convert_task(task):
+    ''' Convert one file (batch worker), return a summary of the run '''
+    typ, in_file, out_file_qif, out_file_csv, stream, stages = task
+    return run_task(in_file, typ, [out_file_qif, out_file_csv],
+                    convert_file, typ, in_file, out_file_qif, out_file_csv,
+                    stream, stages)
+
+
+def run_task(in_file, typ, outputs, func, *args):
+    ''' Run func(*args), returning the number of exported records, and
+    return a summary of the run (records, time, errors and metrics) '''
+    counter = ErrorCounter()
+    logging.getLogger().addHandler(counter)
+    metrics.reset()
+    t0 = time.time()
+    try:
+        cnt = func(*args)
+    except UnicodeError:
+        metrics.count('encoding_errors')
+        logger.exception('! Encoding error, conversion of {} failed'\
+                         .format(in_file))
+        cnt = None
+    except Exception:
+        logger.exception('! Conversion of {} failed'.format(in_file))
+        cnt = None
+    finally:
+        logging.getLogger().removeHandler(counter)
+        # phases interrupted by an error
+        while len(metrics.stack) > 0:
+            metrics.stop()
+    return {'file': in_file,
+            'type': typ,
+            'outputs': outputs,
+            'records': cnt,
+            'time': time.time() - t0,
+            'errors': counter.count,
+            'metrics': metrics.to_dict()}
+
+
+def log_summary(summary_l):
+    ''' Report the per-file results of a batch run '''
+    logger.info('')
+    logger.info('{:<50} {:<15} {:>8} {:>8} {:>6}'.format(
+        'File', 'Type', 'Records', 'Time (s)', 'Errors'))
+    for res in sorted(summary_l, key=lambda res: res['file']):
+        # type and records are None for the files which were not converted
+        logger.info('{:<50} {!s:<15} {!s:>8} {:>8.2f} {:>6}'.format(
+            res['file'], res['type'], res['records'], res['time'],
+            res['errors']))
+    logger.info('=> {} files, {} records, {} errors, {:.2f} s'.format(
+        len(summary_l),
+        sum(res['records'] or 0 for res in summary_l),
+        sum(res['errors'] for res in summary_l),
+        sum(res['time'] for res in summary_l)))
+    total = metrics_total(summary_l)
+    if len(total['timers']) > 0:
+        logger.info('=> Phases: {}'.format(', '.join(
+            '{} {:.2f} s'.format(name, seconds) for name, seconds
+            in sorted(total['timers'].items(), key=lambda item: -item[1]))))
+    if len(total['counters']) > 0:
+        logger.info('=> Counters: {}'.format(', '.join(
+            '{} {}'.format(name, cnt) for name, cnt
+            in sorted(total['counters'].items()))))
+
+
+def metrics_total(summary_l):
+    ''' Sum of the timers and counters of all the files of a run '''
+    timers = Counter()
+    counters = Counter()
+    for res in summary_l:
+        timers.update(res.get('metrics', {}).get('timers', {}))
+        counters.update(res.get('metrics', {}).get('counters', {}))
+    return {'timers': dict(timers), 'counters': dict(counters)}
+
+
+def save_metrics(path, summary_l):
+    ''' Dump the per-file and total timers and counters of a run to JSON '''
+    with open(path, 'w', encoding='utf8') as fid:
+        json.dump({'version': __version__,
+                   'files': sorted(summary_l, key=lambda res: res['file']),
+                   'total': metrics_total(summary_l)},
+                  fid, sort_keys=True, indent=1)
+    logger.info('=> Metrics saved to {}'.format(path))
+
+
+def file_hash(in_file):
+    ''' SHA-1 of the content of a file '''
+    h = hashlib.sha1()
+    with open(in_file, 'rb') as fid:
+        for buff in iter(lambda: fid.read(1 << 16), b''):
+            h.update(buff)
+    return h.hexdigest()
+
+
+def rules_fingerprint(extra=()):
+    ''' Hash of everything the output depends on besides the input files.
+    A change of version or of the rules invalidates the converted files. '''
+    rules = [__version__, PAYMODES,
+             [[fmt.name, fmt.pattern, fmt.parser]
+              for fmt in formats.formats.values()], CSV_HEAD,
+             boursorama_qif_file.rules.rules, list(extra)]
+    return hashlib.sha1(json.dumps(rules, sort_keys=True)
+                        .encode('utf8')).hexdigest()
+
+
+class ConversionManifest:
+    ''' Remembers the files already converted (size, mtime, content hash,
+    type and outputs) so unchanged inputs can be skipped '''
+    def __init__(self, path, force=False, extra=()):
+        self.path = path
+        self.entries = {}
+        self.rules = rules_fingerprint(extra)
+        if force or not isfile(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf8') as fid:
+                data = json.load(fid)
+        except ValueError:
+            logger.warning('! Corrupted manifest {}, ignored.'\
+                           .format(self.path))
+            return
+        if data.get('rules') != self.rules:
+            logger.info('* Converter or rules changed,'
+                        ' all files will be converted.')
+            return
+        self.entries = data['files']
+
+    def is_uptodate(self, in_file, typ, outputs):
+        ''' True if in_file was converted to outputs and did not change '''
+        entry = self.entries.get(in_file)
+        if entry is None or entry['type'] != typ \
+                or entry['outputs'] != outputs \
+                or not all(isfile(out_file) for out_file in outputs):
+            return False
+        st = os.stat(in_file)
+        if entry['size'] != st.st_size:
+            return False
+        if entry['mtime'] == st.st_mtime:
+            return True
+        # touched but possibly unchanged: compare contents
+        if entry['hash'] == file_hash(in_file):
+            entry['mtime'] = st.st_mtime
+            return True
+        return False
+
+    def discard(self, in_file):
+        ''' Forget in_file, whose conversion failed '''
+        self.entries.pop(in_file, None)
+
+    def update(self, in_file, typ, outputs):
+        st = os.stat(in_file)
+        self.entries[in_file] = {'size': st.st_size,
+                                 'mtime': st.st_mtime,
+                                 'hash': file_hash(in_file),
+                                 'type': typ,
+                                 'outputs': outputs}
+
+    def save(self):
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as fid:
+            json.dump({'version': __version__,
+                       'rules': self.rules,
+                       'files': self.entries},
+                      fid, sort_keys=True, indent=1)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_file, self.path)
+
+
+def main_no_args(stream=False, jobs=1, force=False, dedup=False,
+                 categorizer=None, consolidate=False, file_l=None,
+                 ledger=None):
+    ''' Convert the files of "In" (all of them, or the names in file_l)
+    to "Out", without the operations of the HomeBankLedger ledger '''
     logger.debug('Start')
     in_dir = 'In'
     out_dir = 'Out'
 
-    file_l = [f for f in os.listdir(in_dir) if isfile(join(in_dir, f))]
-
+    if file_l is None:
+        file_l = [f for f in os.listdir(in_dir) if isfile(join(in_dir, f))]
+    stages = []
+    extra = []
+    if ledger is not None:
+        stages.append(ledger)
+        extra.append(ledger.fingerprint())
+    if dedup:
+        dedup_index = DuplicateIndex(join(out_dir, DEDUP_INDEX))
+        stages.append(dedup_index)
+        extra.append('dedup')
+        if jobs > 1:
+            # the index is shared by all files
+            logger.warning('! Duplicate detection: files converted'
+                           ' one at a time.')
+            jobs = 1
+    if categorizer is not None:
+        stages.append(categorizer)
+        extra.append(categorizer.fingerprint())
+    manifest = ConversionManifest(join(out_dir, MANIFEST), force, extra)
+
+    task_l = []
+    summary_l = []
+    skipped = 0
     for f in file_l:
-        typ = getTypeFromFileName(f)
         in_file = join(in_dir, f)
-        out_file_csv = join(out_dir, f.replace('.qif', '.csv'))
-        out_file_qif = join(out_dir, f.replace('.csv', '.qif'))
+        typ = detect_type(in_file)
+        out_file_csv = join(out_dir, os.path.splitext(f)[0] + '.csv')
+        out_file_qif = join(out_dir, os.path.splitext(f)[0] + '.qif')
 
         logger.info('')
         logger.info('** In: {}'.format(in_file))
-        if typ == 'INGDiba_csv':
-            data_d = ING_DiBa_csv_file(in_file)
-            HB = HomeBankDataWriter(data_d.dic2HBdic())
-            HB.export_qif(out_file_qif)
-            HB.export_csv(out_file_csv)
-        elif typ == 'Boursorama_qif':
-            data_d = boursorama_qif_file(in_file)
-            HB = HomeBankDataWriter(data_d.dic2HBdic(), data_d.headerline)
-            HB.export_qif(out_file_qif)
-            HB.export_csv(out_file_csv)
-        elif typ == 'Linxo_csv':
-            logger.warning('! Implementation not complete')
-            data_d = linox_csv_file(in_file)
-            HB = HomeBankDataWriter(data_d.dic2HBdic())
-            HB.export_qif(out_file_qif)
-            HB.export_csv(out_file_csv)
-        else:
+        if not formats.can_convert(typ):
             logger.error('! Type not determined for {}'.format(f))
             logger.error('! Skipping.')
+            summary_l.append({'file': in_file, 'type': typ, 'records': None,
+                              'time': 0., 'errors': 1})
+            continue
+        if consolidate:
+            # the outputs depend on all the files, which are always read
+            task_l.append((typ, in_file))
+            continue
+        if manifest.is_uptodate(in_file, typ, [out_file_qif, out_file_csv]):
+            logger.info('* Unchanged since last conversion, skipping.')
+            skipped += 1
+            continue
+        task_l.append((typ, in_file, out_file_qif, out_file_csv, stream,
+                       stages))
+
+    t0 = time.time()
+    if consolidate:
+        logger.info('')
+        logger.info('* Consolidating {} files'.format(len(task_l)))
+        summary_l.append(run_task(in_dir, 'consolidated',
+                                  [join(out_dir, CONSOLIDATED_CSV)],
+                                  consolidate_files, sorted(task_l), out_dir,
+                                  stages))
+        if dedup:
+            for typ, in_file in task_l:
+                dedup_index.commit(in_file,
+                                   summary_l[-1]['records'] is not None)
+    elif jobs > 1 and len(task_l) > 1:
+        logger.info('* Converting {} files with {} processes'\
+                    .format(len(task_l), jobs))
+        pool = multiprocessing.Pool(jobs, init_worker,
+                                    (boursorama_qif_file.rules,
+                                     list(formats.formats.values())))
+        try:
+            summary_l.extend(pool.imap_unordered(convert_task, task_l))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in task_l:
+            res = convert_task(task)
+            if dedup:
+                # the operations of a failed conversion are not indexed, the
+                # next files are checked against the committed ones
+                dedup_index.commit(res['file'], res['records'] is not None)
+            summary_l.append(res)
+    logger.debug('=> Batch done in {:.2f} s'.format(time.time() - t0))
+
+    if not consolidate:
+        for res in summary_l:
+            # records is None if the conversion or the export failed: the
+            # file is converted again on the next run
+            if res['records'] is not None:
+                manifest.update(res['file'], res['type'], res['outputs'])
+            else:
+                manifest.discard(res['file'])
+        manifest.save()
+    if dedup:
+        dedup_index.save()
+        dedup_index.report()
+
+    log_summary(summary_l)
+    if skipped > 0:
+        logger.info('=> {} unchanged files skipped'
+                    ' (use --force to convert them).'.format(skipped))
+    return summary_l
+
+
+class DirectoryWatcher:
+    ''' Reports the new or changed files of a directory, once their size and
+    modification time did not change for interval seconds (files still being
+    written are not reported). Wakes up on changes with inotify if pyinotify
+    is installed, polls every interval seconds otherwise. '''
+    def __init__(self, in_dir, interval=2.):
+        self.in_dir = in_dir
+        self.interval = interval
+        self.known = {}  # name -> (size, mtime) when reported
+        self.pending = {}  # name -> ((size, mtime), time it was seen)
+        self.notifier = None
+        if pyinotify is not None:
+            wm = pyinotify.WatchManager()
+            # events only interrupt the wait, the directory is then scanned
+            self.notifier = pyinotify.Notifier(
+                wm, default_proc_fun=lambda event: None,
+                timeout=int(interval * 1000))
+            wm.add_watch(in_dir, pyinotify.IN_CLOSE_WRITE
+                         | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY)
+
+    def wait(self):
+        ''' Sleep until a change of the directory, at most interval seconds '''
+        if self.notifier is None:
+            time.sleep(self.interval)
+        elif self.notifier.check_events():
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def poll(self):
+        ''' Names of the files changed since they were last reported '''
+        now = time.time()
+        ready = []
+        for f in os.listdir(self.in_dir):
+            path = join(self.in_dir, f)
+            if not isfile(path):
+                continue
+            st = os.stat(path)
+            sig = (st.st_size, st.st_mtime)
+            if self.known.get(f) == sig:
+                self.pending.pop(f, None)
+            elif f not in self.pending or self.pending[f][0] != sig:
+                self.pending[f] = (sig, now)
+            elif now - self.pending[f][1] >= self.interval:
+                del self.pending[f]
+                self.known[f] = sig
+                ready.append(f)
+        return sorted(ready)
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+
+
+def watch_in(interval=2., stream=False, jobs=1, force=False, dedup=False,
+             categorizer=None, consolidate=False, ledger=None):
+    ''' Convert the files of "In" as they are added or changed, until
+    interrupted. The rules and caches stay loaded between conversions.
+    Returns the summaries of all the conversions. '''
+    watcher = DirectoryWatcher('In', interval)
+    summary_l = []
+    logger.info('* Watching "In" ({}), Ctrl-C to stop.'.format(
+        'inotify' if watcher.notifier is not None
+        else 'polling every {} s'.format(interval)))
+    try:
+        while True:
+            file_l = watcher.poll()
+            if len(file_l) > 0:
+                logger.info('')
+                logger.info('* New or changed: {}'.format(', '.join(file_l)))
+                # the consolidated files depend on all the files
+                summary_l.extend(main_no_args(
+                    stream, jobs, force, dedup, categorizer, consolidate,
+                    None if consolidate else file_l, ledger))
+            watcher.wait()
+    except KeyboardInterrupt:
+        logger.info('=> Stopped watching "In".')
+    finally:
+        watcher.close()
+    return summary_l
 
 
 def main():
@@ -502,16 +2257,73 @@ def main():
 
     p = argparse.ArgumentParser()
     p.add_argument('-i', '--input', help="input file")
-    types = filetypes.keys()
+    types = formats.names()
     p.add_argument('-t', '--type', choices=types, help="Type of the file")
+    p.add_argument('-s', '--stream', action='store_true',
+                   help="convert records one at a time (constant memory)")
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help="number of files converted in parallel (\"In\" only)")
+    p.add_argument('-f', '--force', action='store_true',
+                   help="convert all files of \"In\", even unchanged ones")
+    p.add_argument('-d', '--dedup', action='store_true',
+                   help="drop operations already exported from another file")
+    p.add_argument('-r', '--rules',
+                   help="JSON/YAML file of Boursorama rules, tried first")
+    p.add_argument('-c', '--categories',
+                   help="JSON/YAML file of category rules")
+    p.add_argument('--history',
+                   help="CSV exported by HomeBank to learn categories from")
+    p.add_argument('--xhb',
+                   help="HomeBank file (.xhb) whose operations are not"
+                   " exported again")
+    p.add_argument('--consolidate', action='store_true',
+                   help="one QIF per account and one CSV for all the files"
+                   " of \"In\"")
+    p.add_argument('-w', '--watch', action='store_true',
+                   help="convert the files of \"In\" as they are added or"
+                   " changed")
+    p.add_argument('--interval', type=float, default=2.,
+                   help="seconds a file must be unchanged before conversion"
+                   " (--watch)")
+    p.add_argument('--metrics',
+                   help="JSON file to save the timers and counters of the run")
+    p.add_argument('--profile',
+                   help="profile the run with cProfile, stats saved to a file")
     # sys.getfilesystemencoding()
 
     args = p.parse_args()
-    print args
-
-    if args.input == None:
+    print(args)
+
+    if args.rules is not None:
+        boursorama_qif_file.rules = RuleEngine(load_rules(args.rules)
+                                               + BOURSORAMA_RULES)
+    categorizer = None
+    if args.categories is not None or args.history is not None:
+        categorizer = Categorizer(load_rules(args.categories)
+                                  if args.categories is not None else (),
+                                  args.history)
+    ledger = None
+    if args.xhb is not None:
+        ledger = HomeBankLedger(args.xhb)
+
+    profiler = None
+    if args.profile is not None:
+        if args.jobs > 1:
+            # the workers would not be profiled
+            logger.warning('! Profiling: files converted one at a time.')
+            args.jobs = 1
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if args.watch:
+        summary_l = watch_in(args.interval, args.stream, args.jobs,
+                             args.force, args.dedup, categorizer,
+                             args.consolidate, ledger)
+    elif args.input == None:
         logger.info('* No arguments, attempting to automatically process "In"')
-        main_no_args()
+        summary_l = main_no_args(args.stream, args.jobs, args.force,
+                                 args.dedup, categorizer, args.consolidate,
+                                 ledger=ledger)
     else:
         logger.info('* In: {}'.format(args.input))
         if not isfile(args.input):
@@ -519,33 +2331,47 @@ def main():
             raise ValueError
         if args.type == None:
             logger.info('* No type defined, trying to determine')
-            typ = getTypeFromFileName(args.input)
+            typ = detect_type(args.input)
         else:
             typ = args.type
 
         in_file = args.input
-        out_file_csv = os.path.abspath(in_file.replace('.qif', 'conv.csv'))
-        out_file_qif = os.path.abspath(in_file.replace('.csv', 'conv.qif'))
-
-        if typ == 'INGDiba_csv':
-            data_d = ING_DiBa_csv_file(in_file)
-            HB = HomeBankDataWriter(data_d.dic2HBdic())
-            HB.export_qif(out_file_qif)
-            HB.export_csv(out_file_csv)
-        elif typ == 'Boursorama_qif':
-            data_d = boursorama_qif_file(in_file)
-            HB = HomeBankDataWriter(data_d.dic2HBdic(), data_d.headerline)
-            HB.export_qif(out_file_qif)
-            HB.export_csv(out_file_csv)
-        elif typ == 'Linxo_csv':
-            logger.warning('! Implementation not complete')
-            data_d = linox_csv_file(in_file)
-            HB = HomeBankDataWriter(data_d.dic2HBdic())
-            HB.export_qif(out_file_qif)
-            HB.export_csv(out_file_csv)
-        else:
-            logger.error('! Type not determined for {}'.format(in_file))
-            logger.error('! Skipping.')
+        # never the input file itself
+        out_file_csv = os.path.abspath(os.path.splitext(in_file)[0]
+                                       + 'conv.csv')
+        out_file_qif = os.path.abspath(os.path.splitext(in_file)[0]
+                                       + 'conv.qif')
+
+        stages = []
+        if ledger is not None:
+            stages.append(ledger)
+        if args.dedup:
+            dedup_index = DuplicateIndex(join(os.path.dirname(out_file_qif),
+                                              DEDUP_INDEX))
+            stages.append(dedup_index)
+        if categorizer is not None:
+            stages.append(categorizer)
+        summary_l = [convert_task((typ, in_file, out_file_qif, out_file_csv,
+                                   args.stream, stages))]
+        if args.dedup:
+            dedup_index.commit(in_file, summary_l[0]['records'] is not None)
+            dedup_index.save()
+            dedup_index.report()
+        log_summary(summary_l)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        stats = pstats.Stats(args.profile)
+        stats.sort_stats('cumulative')
+        logger.info('=> Profile saved to {} (python -m pstats {}),'
+                    ' slowest functions:'.format(args.profile, args.profile))
+        for func, (cc, nc, tt, ct, callers) in sorted(
+                stats.stats.items(), key=lambda item: -item[1][3])[:15]:
+            logger.info('  {:>8.3f} s {:>8} calls  {}:{}({})'.format(
+                ct, nc, *func))
+    if args.metrics is not None:
+        save_metrics(args.metrics, summary_l)
 
 
 if __name__ == "__main__":